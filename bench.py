@@ -0,0 +1,209 @@
+import logging
+import json
+import time
+import os
+import tempfile
+from collections import Counter
+
+from kasli import Kasli
+import i2c_sim
+import chips
+
+logger = logging.getLogger(__name__)
+
+
+benchmarks = {}
+destructive = set()
+
+
+def benchmark(f=None, write=False):
+    """Register a benchmark, `write` ones alter hardware contents"""
+    def register(f):
+        benchmarks[f.__name__] = f
+        if write:
+            destructive.add(f.__name__)
+        return f
+    return register(f) if f is not None else register
+
+
+def si5324_settings():
+    return chips.Si5324.FrequencySettings.default()
+
+
+def sim_description():
+    return {
+        "target": "kasli", "hw_rev": "v2.0", "vendor": "QUARTIQ",
+        "peripherals": [
+            {"type": "urukul", "hw_rev": "v1.5", "ports": [0, 1]},
+            {"type": "sampler", "hw_rev": "v2.2", "ports": [2, 6]},
+            {"type": "zotino", "hw_rev": "v1.3", "ports": [7]},
+        ]}
+
+
+@benchmark
+def scan_devices(bus, args):
+    bus.scan_devices()
+
+
+@benchmark
+def dump_eeproms(bus, args):
+    bus.dump_eeproms()
+
+
+@benchmark(write=True)
+def si5324_setup(bus, args):
+    with bus.enabled("LOC0"):
+        chips.Si5324(bus).setup(si5324_settings())
+
+
+@benchmark(write=True)
+def spiflash_flash(bus, args):
+    import flash_fastino
+    with bus.enabled(args.flash_eem):
+        b = flash_fastino.Fastino(bus)
+        b.init()
+        with b.flash_upd():
+            part = b.flash.identify()
+            offset = args.flash_offset
+            if offset is None:
+                # scratch area at the end, clear of the gateware
+                if part.size is None:
+                    raise ValueError("unknown flash size, use --flash-offset")
+                offset = (part.size - args.flash_size) & ~(
+                    b.flash.sector - 1)
+            b.flash.flash(offset, os.urandom(args.flash_size))
+
+
+@benchmark(write=True)
+def deploy_sinara_flash(bus, args):
+    import deploy_sinara
+    if args.description:
+        with open(args.description) as f:
+            description = json.load(f)
+    else:
+        description = sim_description()
+    ss = [deploy_sinara.get_kasli(description)]
+    ss.extend(deploy_sinara.get_eem(p) for p in description["peripherals"])
+    deploy_sinara.flash(description, ss, bus=bus)
+
+
+def run(bus, names, args, clock=time.monotonic):
+    results = []
+    for name in names:
+        usb = Counter(bus.usb)
+        t = clock()
+        benchmarks[name](bus, args)
+        t = clock() - t
+        usb = Counter(bus.usb) - usb
+        results.append(dict(
+            name=name, wall=t, transactions=usb["transactions"],
+            bytes=usb["bytes"], usb=usb["issued"], elided=usb["elided"]))
+        logger.warning("%s: %.3f s, %d transactions, %d bytes, "
+                       "%d USB round-trips", name, t, usb["transactions"],
+                       usb["bytes"], usb["issued"])
+    return results
+
+
+def compare(results, old, tolerance=.1):
+    old = {r["name"]: r for r in old["results"]}
+    regressions = []
+    for r in results:
+        if r["name"] not in old:
+            continue
+        o = old[r["name"]]
+        for k in "wall", "usb", "transactions":
+            if not o[k]:
+                continue
+            ratio = r[k]/o[k]
+            logger.warning("%s %s: %g -> %g (%.2fx)", r["name"], k,
+                           o[k], r[k], ratio)
+            if ratio > 1 + tolerance:
+                regressions.append((r["name"], k, ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser()
+    p.add_argument("-s", "--serial", default="0")
+    p.add_argument("-p", "--port", default=2, type=int)
+    p.add_argument("-b", "--backend", default="auto",
+                   choices=["auto"] + sorted(Kasli.backends))
+    p.add_argument("--sim", action="store_true",
+                   help="use the simulated bus instead of hardware")
+    p.add_argument("--profile", default="bitbang",
+                   choices=sorted(i2c_sim.Latency.profiles),
+                   help="simulated driver latency profile")
+    p.add_argument("--latency", default=125e-6, type=float,
+                   help="simulated USB round-trip time")
+    p.add_argument("--sleep", action="store_true",
+                   help="sleep the simulated latency (wall time)")
+    p.add_argument("-w", "--write", action="store_true",
+                   help="allow benchmarks that write to hardware")
+    p.add_argument("--description", help="system description JSON "
+                   "for deploy_sinara_flash")
+    p.add_argument("--flash-eem", default="EEM4")
+    p.add_argument("--flash-size", default=1 << 16, type=int)
+    p.add_argument("--flash-offset", default=None, type=lambda x: int(x, 0),
+                   help="scratch flash area (default: the end of the flash)")
+    p.add_argument("-o", "--output", default="bench.json")
+    p.add_argument("-c", "--compare", help="earlier results to compare to")
+    p.add_argument("-t", "--tolerance", default=.1, type=float)
+    p.add_argument("-v", "--verbose", default=0, action="count")
+    p.add_argument("benchmark", nargs="*")
+    args = p.parse_args()
+
+    logging.basicConfig(
+        level=[logging.WARNING, logging.INFO, logging.DEBUG][args.verbose])
+
+    names = args.benchmark or [
+        n for n in benchmarks
+        if args.sim or args.write or n not in destructive]
+    for name in names:
+        if not args.sim and not args.write and name in destructive:
+            raise ValueError("benchmark writes to hardware, use --write",
+                             name)
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    if args.sim:
+        url = "sim"
+        root = i2c_sim.kasli_tree(fpga_eems={4: "fastino"})
+        latency = i2c_sim.Latency(args.profile, args.latency)
+        bus = Kasli("sim", root=root, latency=latency,
+                    sleep=args.sleep).configure(url)
+        clock = bus.time
+    else:
+        url = "ftdi://ftdi:4232h:{}/{}".format(args.serial, args.port)
+        bus = Kasli(args.backend).configure(url)
+        clock = time.monotonic
+    meta = dict(url=url, backend=bus.backend, throughput=bus.throughput,
+                profile=args.profile if args.sim else None,
+                latency=args.latency if args.sim else None,
+                date=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+    # chip tools write data/ files relative to the working directory
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as d:
+        os.mkdir(os.path.join(d, "data"))
+        os.chdir(d)
+        try:
+            with bus:
+                bus.reset()
+                try:
+                    results = run(bus, names, args, clock)
+                finally:
+                    bus.enable()
+        finally:
+            os.chdir(cwd)
+
+    with open(output, "w") as f:
+        json.dump(dict(meta=meta, results=results), f, indent=4)
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, k, ratio in regressions:
+            logger.error("regression %s %s: %.2fx", name, k, ratio)
+        if regressions:
+            raise SystemExit(1)
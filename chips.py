@@ -2,6 +2,12 @@ import time
 import logging
 from contextlib import contextmanager
 import struct
+import os
+import re
+import json
+import hashlib
+import mmap
+from collections import namedtuple
 
 from sinara import Sinara
 from pyftdi.i2c import I2cNackError
@@ -9,9 +15,183 @@ from pyftdi.i2c import I2cNackError
 logger = logging.getLogger(__name__)
 
 
+# completion time statistics per operation, see `wait()`
+wait_stats = {}
+
+
+def wait(done, op, hint, timeout, bus=None, backoff=2., alpha=.25):
+    """Poll `done()` until true, return the time it took
+
+    Sleeps most of the expected latency first and backs off exponentially
+    from there. The expected latency is `hint` scaled by the running
+    estimate of the completion time to hint ratio of `op`: it shrinks if
+    the first poll succeeds and otherwise tracks the midpoint between the
+    last failed and the successful poll. A bus with `time()` and `delay()`
+    (the simulator) provides the clock.
+    """
+    clock = getattr(bus, "time", time.monotonic)
+    delay = getattr(bus, "delay", time.sleep)
+    stats = wait_stats.setdefault(op, dict(n=0, scale=1., max=0., polls=0))
+    expect = hint*stats["scale"]
+    t0 = clock()
+    if expect > 1e-4:  # shorter than a USB round trip
+        delay(.9*expect)
+    interval = max(expect/4, 1e-4)
+    failed = None
+    polls = 0
+    while True:
+        t = clock() - t0
+        polls += 1
+        if done():
+            break
+        failed = t
+        if t > timeout:
+            raise ValueError("{} timeout".format(op))
+        delay(min(interval, timeout - t))
+        interval *= backoff
+    if failed is None:
+        stats["scale"] = max(stats["scale"]*(1 - alpha), 1e-3)
+    else:
+        stats["scale"] += alpha*((failed + t)/2/hint - stats["scale"])
+    t = clock() - t0
+    stats["n"] += 1
+    stats["max"] = max(stats["max"], t)
+    stats["polls"] += polls
+    logger.debug("%s took %g s, %d polls", op, t, polls)
+    return t
+
+
+def drain(steps):
+    """Run a generator (e.g. `SPIFlash.program_steps()`) to the end,
+    return its value"""
+    while True:
+        try:
+            next(steps)
+        except StopIteration as e:
+            return e.value
+
+
+def runs(addrs, gap=0, known=()):
+    """Group addresses into (start, length) runs, bridging up to `gap`
+    `known` addresses"""
+    runs = []
+    for addr in sorted(addrs):
+        if runs and addr - sum(runs[-1]) <= gap and all(
+                i in known for i in range(sum(runs[-1]), addr)):
+            runs[-1][1] = addr - runs[-1][0] + 1
+        else:
+            runs.append([addr, 1])
+    return runs
+
+
+Chip = namedtuple("Chip", "kind addr info")
+
+
+class Inventory(dict):
+    """Identified chips, port -> {addr: Chip}"""
+    def find(self, kind):
+        for port, chips in self.items():
+            for chip in chips.values():
+                if chip.kind == kind:
+                    yield port, chip
+
+    def expect(self):
+        """Addresses per port, for a subsequent `ScanI2C.inventory()`"""
+        return {port: sorted(chips) for port, chips in self.items()}
+
+    def report(self):
+        for port, chips in self.items():
+            for chip in chips.values():
+                logger.info("%s %#04x %s: %s", port, chip.addr, chip.kind,
+                            chip.info)
+
+
+class Snapshot(dict):
+    """Crate health readings, port -> {addr: values}"""
+    def alarms(self):
+        """(port, addr, condition) for every reading out of order"""
+        for port, found in self.items():
+            for addr, v in found.items():
+                if "error" in v:
+                    yield port, addr, v["error"]
+                elif v["kind"] == "lm75" and v["overtemp"]:
+                    yield port, addr, "overtemp"
+                elif v["kind"] == "si5324":
+                    for flag in "has_xtal", "has_clkin2", "locked":
+                        if not v[flag]:
+                            yield port, addr, "not " + flag
+                elif v["kind"] == "sff8472":
+                    for flag in "tx_fault", "rx_los":
+                        if v.get(flag):
+                            yield port, addr, flag
+                    for alarm in v.get("alarm", ()):
+                        yield port, addr, alarm
+
+    def report(self):
+        for port, found in self.items():
+            for addr, v in found.items():
+                logger.info("%s %#04x %s", port, addr, v)
+        for port, addr, alarm in self.alarms():
+            logger.warning("%s %#04x: %s", port, addr, alarm)
+
+
 class ScanI2C:
+    def identify(self, addr):
+        """Identify a responding chip from its signature registers"""
+        if addr in (0x50, 0x57):
+            head = bytes(self.read_many(addr, 0, 64))
+            magic, = struct.unpack(">H", head[4:6])
+            cc_base = head[63]
+            if (magic != Sinara._magic and cc_base not in (0x00, 0xff) and
+                    cc_base == sum(head[:63]) & 0xff):
+                return Chip("sff8472", addr, dict(
+                    vendor=head[20:36].strip(), part=head[40:56].strip()))
+            eui48 = EEPROM(self, addr).fmt_eui48()
+            if magic == Sinara._magic:
+                board, = struct.unpack(">H", head[16:18])
+                name = head[6:16].strip(b"\x00").decode(errors="replace")
+                return Chip("sinara", addr, dict(
+                    eui48=eui48, name=name, board=board,
+                    hw_rev="v{}.{}".format(head[19], head[20])))
+            return Chip("eeprom", addr, dict(eui48=eui48))
+        if addr == 0x68:
+            ident = bytes(self.read_many(addr, 134, 2))
+            if ident == b"\x01\x82":
+                return Chip("si5324", addr, dict(ident=ident.hex()))
+        elif 0x48 <= addr < 0x50:
+            # LM75 config, bits 7:5 are always zero
+            cfg = self.read_many(addr, 0x01, 1)[0]
+            if not cfg & 0xe0:
+                return Chip("lm75", addr, dict(config=cfg))
+        elif addr == 0x3e:
+            return Chip("pcf8574", addr, dict(io=self.read_single(addr)))
+        elif 0x70 <= addr < 0x78:
+            return Chip("pca9548", addr, dict(ports=self.read_single(addr)))
+        elif 0x28 <= addr < 0x30:
+            # write-only registers, identified by the address
+            return Chip("sc18is602b", addr, {})
+        return Chip("unknown", addr, {})
+
+    def scan_chips(self, expect=None, full=False, skip=()):
+        """Poll and identify the chips in the current scope
+
+        The `expect` addresses are probed first and the scan stops there if
+        all of them respond. Without `expect`, with `full` or if an
+        expected address is missing the whole address space is polled.
+        `skip` addresses (e.g. the switches upstream) are not polled.
+        """
+        probe = [addr for addr in expect or () if addr not in skip]
+        found = list(self.scan(probe))
+        if full or expect is None or len(found) != len(probe):
+            found.extend(self.scan(
+                addr for addr in range(0x08, 0x78)
+                if addr not in probe and addr not in skip))
+        return {addr: self.identify(addr) for addr in sorted(found)}
+
     def scan(self, addrs=None):
-        for addr in addrs or range(0x08, 0x78):
+        if addrs is None:
+            addrs = range(0x08, 0x78)
+        for addr in addrs:
             if self.poll(addr, write=True):
                 yield addr
 
@@ -30,6 +210,48 @@ class ScanI2C:
                     yield [(addr, port)] + path, sub
             self.write_single(addr, 0)
 
+    def scan_graph(self, addr_mask=(0x70, 0x78), addrs=None, skip=[],
+                   cached=None, probe=(0x50,)):
+        """Scan into a graph like `make_graph()`, including empty switches
+
+        With a `cached` graph only its addresses (and the `probe` addresses)
+        are polled in each scope, a scope is fully rescanned only if they
+        don't match. Subtrees of unchanged switches are checked the same
+        way.
+        """
+        found = None
+        if cached is not None:
+            check = set(cached) | (set(probe) - set(skip))
+            if all(self.poll(addr, write=True) == (addr in cached)
+                   for addr in sorted(check)):
+                found = list(cached)
+            else:
+                logger.info("scope changed, rescanning")
+        if found is None:
+            found = [addr for addr in self.scan(addrs) if addr not in skip]
+        graph = {}
+        for addr in found:
+            if (addr ^ addr_mask[0]) & addr_mask[1]:
+                graph[addr] = None
+                continue
+            sub = (cached or {}).get(addr) or [None]*8
+            graph[addr] = []
+            for port in range(8):
+                self.write_single(addr, 1 << port)
+                graph[addr].append(self.scan_graph(
+                    addr_mask, addrs, skip + found, sub[port], probe))
+            self.write_single(addr, 0)
+        return graph
+
+    def graph_leaves(self, graph, path=[]):
+        """Flatten a graph into (path, addr) like `scan_tree()`"""
+        for addr, ports in graph.items():
+            if ports is None:
+                yield path, addr
+                continue
+            for port, sub in enumerate(ports):
+                yield from self.graph_leaves(sub, path + [(addr, port)])
+
     def make_graph(self, it):
         root = {}
         for path, addr in it:
@@ -51,13 +273,115 @@ class ScanI2C:
                 yield from self.format_graph(children, level + indent, indent)
 
 
+class MuxTree:
+    """Shadow of the port registers of a tree of PCA9548 switches
+
+    A path is a sequence of (switch address, port) hops from the root, a
+    switch is keyed by its upstream path and address. `enable()` writes
+    only the switches whose register differs from the target, top-down so
+    that nested switches are reachable when written. Switches not on any
+    target path are turned off only if they remain reachable.
+    """
+    def __init__(self, bus, switches=()):
+        self.bus = bus
+        # (upstream path, address): port bits, None if unknown
+        self.state = {((), addr): None for addr in switches}
+        self.paths = []
+
+    def reset(self):
+        """The root switches are off after a hardware reset
+
+        The RESET line does not reach nested (on-board) switches, their
+        state becomes unknown.
+        """
+        for key in self.state:
+            self.state[key] = None if key[0] else 0
+        self.paths = []
+
+    def invalidate(self):
+        for key in self.state:
+            self.state[key] = None
+
+    @staticmethod
+    def reachable(upstream, state):
+        return all((state.get((upstream[:i], addr)) or 0) & (1 << port)
+                   for i, (addr, port) in enumerate(upstream))
+
+    def target(self, paths):
+        want = {}
+        for path in paths:
+            for i, (addr, port) in enumerate(path):
+                key = (tuple(path[:i]), addr)
+                want[key] = want.get(key, 0) | (1 << port)
+        for key in self.state:
+            if key not in want and self.reachable(key[0], want):
+                want[key] = 0
+        return want
+
+    def plan(self, paths):
+        """Switch writes from the current to the target paths"""
+        want = self.target(paths)
+        return sorted(((key, bits) for key, bits in want.items()
+                       if self.state.get(key) != bits),
+                      key=lambda kb: len(kb[0][0]))
+
+    def write(self, upstream, addr, bits):
+        # every reachable switch at that address sees the write
+        for key in self.state:
+            if key[1] == addr and key[0] != upstream:
+                if self.reachable(key[0], self.state):
+                    self.state[key] = bits
+                elif any(self.state.get((key[0][:i], a)) is None
+                         for i, (a, p) in enumerate(key[0])):
+                    self.state[key] = None
+        self.bus.write_single(addr, bits)
+        self.state[(upstream, addr)] = bits
+
+    def enable(self, *paths, verify=False):
+        for (upstream, addr), bits in self.plan(paths):
+            self.write(upstream, addr, bits)
+        self.paths = [tuple(path) for path in paths]
+        if verify:
+            self.verify()
+
+    def set_switch(self, addr, bits):
+        """Write a nested switch reached through the enabled path"""
+        if len(self.paths) == 1:
+            upstream = self.paths[0]
+            if self.state.get((upstream, addr)) != bits:
+                self.write(upstream, addr, bits)
+        else:
+            self.bus.write_single(addr, bits)
+            for key in self.state:
+                if key[1] == addr:
+                    self.state[key] = None
+
+    def verify(self):
+        """Read back the reachable switches, return the mismatches"""
+        bad = []
+        for key, bits in sorted(self.state.items(),
+                                key=lambda kb: len(kb[0][0])):
+            if not self.reachable(key[0], self.state):
+                continue
+            actual = self.bus.read_single(key[1])
+            if actual != bits:
+                logger.warning("switch %s %#04x: %s != %#04x", key[0],
+                               key[1], bits, actual)
+                self.state[key] = actual
+                bad.append(key)
+        return bad
+
+
 class PCA9548:
     def __init__(self, bus, addr=0x70):
         self.bus = bus
         self.addr = addr
 
     def set(self, ports):
-        self.bus.write_single(self.addr, ports)
+        if hasattr(self.bus, "mux"):
+            self.bus.mux.set_switch(self.addr, ports)
+        else:
+            self.bus.write_single(self.addr, ports)
 
     def get(self):
         return self.bus.read_single(self.addr)
@@ -85,6 +409,106 @@ class Si5324:
         n2_ls = None
         bwsel = None
 
+        @classmethod
+        def default(cls):
+            """125 MHz CKOUT, 100 MHz CKIN1, free run from the 114.285 MHz
+            CKIN2 XTAL"""
+            s = cls()
+            s.n31 = 4993
+            s.n32 = 4565
+            s.n1_hs = 10
+            s.nc1_ls = 4
+            s.nc2_ls = 4
+            s.n2_hs = 10
+            s.n2_ls = 19972
+            s.bwsel = 4
+            return s
+
+        # narrowband limits: DCO and phase detector (f3) frequencies
+        f_dco = (4.85e9, 5.67e9)
+        f_pd = (2e3, 2e6)
+        _plans = {}
+
+        def __repr__(self):
+            return "FrequencySettings({})".format(", ".join(
+                "{}={}".format(k, getattr(self, k)) for k in (
+                    "n31", "n32", "n1_hs", "nc1_ls", "nc2_ls", "n2_hs",
+                    "n2_ls", "bwsel")))
+
+        @classmethod
+        def solve(cls, ckout, ckin1=None, ckin2=None, bwsel=4, n=10):
+            """Ranked divider settings for CKOUT from CKIN1/CKIN2 (in Hz)
+
+            All given inputs share the phase detector frequency, a missing
+            input gets the divider of the other one. Plans are ranked by
+            phase detector frequency and then DCO frequency. `bwsel` is
+            not derived, pick it for the plan with DSPLLsim.
+            """
+            key = ckout, ckin1, ckin2
+            if key not in cls._plans:
+                cls._plans[key] = cls._solve(*key)
+            plans = []
+            for plan in cls._plans[key][:n].tolist():
+                n31, n32, n1_hs, nc_ls, n2_hs, n2_ls = plan
+                s = cls()
+                s.n31, s.n32 = n31, n32
+                s.n1_hs, s.nc1_ls, s.nc2_ls = n1_hs, nc_ls, nc_ls
+                s.n2_hs, s.n2_ls = n2_hs, n2_ls
+                s.bwsel = bwsel
+                plans.append(s)
+            return plans
+
+        @classmethod
+        def _solve(cls, ckout, ckin1, ckin2, limit=1000, block=256):
+            import numpy as np
+
+            ckin = [int(f) for f in (ckin1, ckin2) if f is not None]
+            if not ckin:
+                raise ValueError("no input frequency")
+            ckout = int(ckout)
+            # output dividers within the DCO range, NCn_LS even for map()
+            n1_hs = np.arange(4, 12, dtype=np.int64)[:, None]
+            nc_max = min(int(cls.f_dco[1]//(4*ckout)), 1 << 20)
+            nc_ls = np.arange(2, nc_max + 1, 2, dtype=np.int64)
+            f_osc = ckout*n1_hs*nc_ls
+            i, j = np.nonzero((f_osc >= cls.f_dco[0]) &
+                              (f_osc <= cls.f_dco[1]))
+            n1_hs, nc_ls, f_osc = n1_hs[i, 0], nc_ls[j], f_osc[i, j]
+            n2_hs = np.arange(4, 12, dtype=np.int64)
+            # f3 = g/m divides all inputs, highest f3 (lowest m) first
+            g = int(np.gcd.reduce(ckin))
+            m_min = max(1, -(-g//int(cls.f_pd[1])))
+            m_max = min(g//int(cls.f_pd[0]), (1 << 19)*g//max(ckin))
+            plans = []
+            found = 0
+            for m0 in range(m_min, m_max + 1, block):
+                m = np.arange(m0, min(m0 + block, m_max + 1), dtype=np.int64)
+                # integer feedback divider N2 = f_osc/f3
+                n2 = f_osc[:, None]*m
+                i, j = np.nonzero(n2 % g == 0)
+                n2 = n2[i, j]//g
+                # N2 = N2_HS*N2_LS, N2_LS even
+                n2_ls = n2[:, None]//n2_hs
+                k, l = np.nonzero((n2[:, None] % n2_hs == 0) &
+                                  (n2_ls % 2 == 0) & (n2_ls <= 1 << 20))
+                i, j = i[k], j[k]
+                n3 = [f*m[j]//g for f in ckin]
+                plan = np.stack((
+                    n3[0] if ckin1 is not None else n3[-1], n3[-1],
+                    n1_hs[i], nc_ls[i], n2_hs[l], n2_ls[k, l],
+                    m[j], f_osc[i]), -1)
+                plans.append(plan)
+                found += len(plan)
+                if found >= limit:
+                    break
+            plans = np.concatenate(plans) if plans else np.zeros((0, 8), int)
+            # then lowest DCO frequency, highest N1_HS and N2_HS
+            order = np.lexsort((-plans[:, 4], -plans[:, 2], plans[:, 7],
+                                plans[:, 6]))
+            plans = plans[order[:limit], :6]
+            plans.flags.writeable = False
+            return plans
+
         def map(self, settings):
             if settings.nc1_ls != 0 and (settings.nc1_ls % 2) == 1:
                 raise ValueError("NC1_LS must be 0 or even")
@@ -116,16 +540,58 @@ class Si5324:
             self.bwsel = settings.bwsel
             return self
 
-    def __init__(self, bus, addr=0x68):
+    # registers shown by `dump()`
+    registers = (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 19, 20, 21, 22, 23, 24,
+                 25, 31, 32, 33, 34, 35, 36, 40, 41, 42, 43, 44, 45, 46, 47,
+                 48, 55, 131, 132, 137, 138, 139, 142, 143, 136)
+
+    t_lock = .1
+
+    def __init__(self, bus, addr=0x68, gap=2):
         self.bus = bus
         self.addr = addr
+        # shadow register file, flushed in bursts bridging up to `gap`
+        # clean but known registers
+        self.regs = {}
+        self.dirty = set()
+        self.gap = gap
 
     def write(self, addr, data):
         self.bus.write_many(self.addr, addr, [data])
+        self.regs[addr] = data
+        self.dirty.discard(addr)
 
     def read(self, addr):
         return self.bus.read_many(self.addr, addr, 1)[0]
 
+    def load(self, addrs):
+        """Read registers into the shadow in contiguous bursts"""
+        for start, length in runs(addrs):
+            data = self.bus.read_many(self.addr, start, length)
+            self.regs.update(zip(range(start, start + length), data))
+            self.dirty.difference_update(range(start, start + length))
+
+    def update(self, addr, mask, value):
+        """Modify the bits `mask` of a shadow register"""
+        if addr not in self.regs:
+            self.load([addr])
+        new = (self.regs[addr] & ~mask) | (value & mask)
+        if new != self.regs[addr]:
+            self.regs[addr] = new
+            self.dirty.add(addr)
+
+    def set(self, addr, value):
+        if self.regs.get(addr) != value:
+            self.regs[addr] = value
+            self.dirty.add(addr)
+
+    def flush(self):
+        """Write dirty registers, merging neighbors into bursts"""
+        for start, length in runs(self.dirty, self.gap, self.regs):
+            self.bus.write_many(self.addr, start, [
+                self.regs[i] for i in range(start, start + length)])
+        self.dirty.clear()
+
     def ident(self):
         return self.bus.read_many(self.addr, 134, 2)
 
@@ -141,12 +607,15 @@ class Si5324:
     def locked(self):
         return self.read(130) & 0x01 == 0  # LOL_INT=0
 
+    def sample(self):
+        """LOS and LOL flags from one read"""
+        los, lol = self.bus.read_many(self.addr, 129, 2)
+        return dict(has_xtal=not los & 0x01, has_clkin1=not los & 0x02,
+                    has_clkin2=not los & 0x04, locked=not lol & 0x01)
+
     def wait_lock(self, timeout=20):
-        t = time.monotonic()
-        while not self.locked():
-            if time.monotonic() - t > timeout:
-                raise ValueError("lock timeout")
-        logger.info("locking took %g s", time.monotonic() - t)
+        t = wait(self.locked, "si5324 lock", self.t_lock, timeout, self.bus)
+        logger.info("locking took %g s", t)
 
     def select_input(self, inp):
         self.write(3, self.read(3) & 0x3f | (inp << 6))
@@ -164,33 +633,36 @@ class Si5324:
         self.write(136, 0x00)
         time.sleep(.01)
 
-        self.write(0,   self.read(0) | 0x40)  # FREE_RUN=1
-        # self.write(0,   self.read(0) & ~0x40)  # FREE_RUN=0
-        self.write(2,   (self.read(2) & 0x0f) | (s.bwsel << 4))
-        self.write(21,  self.read(21) & 0xfe)  # CKSEL_PIN=0
-        self.write(22,  self.read(22) & 0xfd)  # LOL_POL=0
-        self.write(19,  self.read(19) & 0xf7)  # LOCKT=0
-        self.write(3,   (self.read(3) & 0x3f) | (0b01 << 6) | 0x10)  # CKSEL_REG=b01 SQ_ICAL=1
-        self.write(4,   (self.read(4) & 0x3f) | (0b00 << 6))  # AUTOSEL_REG=b00
-        self.write(6,   (self.read(6) & 0xc0) | 0b101101)  # SFOUT2_REG=b101 SFOUT1_REG=b101
-        self.write(25,  (s.n1_hs  << 5 ))
-        self.write(31,  (s.nc1_ls >> 16))
-        self.write(32,  (s.nc1_ls >> 8 ))
-        self.write(33,  (s.nc1_ls)      )
-        self.write(34,  (s.nc2_ls >> 16))
-        self.write(35,  (s.nc2_ls >> 8 ))
-        self.write(36,  (s.nc2_ls)      )
-        self.write(40,  (s.n2_hs  << 5 ) | (s.n2_ls  >> 16))
-        self.write(41,  (s.n2_ls  >> 8 ))
-        self.write(42,  (s.n2_ls)       )
-        self.write(43,  (s.n31    >> 16))
-        self.write(44,  (s.n31    >> 8) )
-        self.write(45,  (s.n31)         )
-        self.write(46,  (s.n32    >> 16))
-        self.write(47,  (s.n32    >> 8) )
-        self.write(48,  (s.n32)         )
-        self.write(137, self.read(137) | 0x01)  # FASTLOCK=1
-        self.write(136, self.read(136) | 0x40)  # ICAL=1
+        self.load([0, 2, 3, 4, 6, 19, 21, 22, 137])
+        self.update(0, 0x40, 0x40)  # FREE_RUN=1
+        # self.update(0, 0x40, 0x00)  # FREE_RUN=0
+        self.update(2, 0xf0, s.bwsel << 4)
+        self.update(21, 0x01, 0x00)  # CKSEL_PIN=0
+        self.update(22, 0x02, 0x00)  # LOL_POL=0
+        self.update(19, 0x08, 0x00)  # LOCKT=0
+        self.update(3, 0xd0, (0b01 << 6) | 0x10)  # CKSEL_REG=b01 SQ_ICAL=1
+        self.update(4, 0xc0, 0b00 << 6)  # AUTOSEL_REG=b00
+        self.update(6, 0x3f, 0b101101)  # SFOUT2_REG=b101 SFOUT1_REG=b101
+        self.set(25,  (s.n1_hs  << 5 ))
+        self.set(31,  (s.nc1_ls >> 16))
+        self.set(32,  (s.nc1_ls >> 8 ) & 0xff)
+        self.set(33,  (s.nc1_ls)       & 0xff)
+        self.set(34,  (s.nc2_ls >> 16))
+        self.set(35,  (s.nc2_ls >> 8 ) & 0xff)
+        self.set(36,  (s.nc2_ls)       & 0xff)
+        self.set(40,  (s.n2_hs  << 5 ) | (s.n2_ls  >> 16))
+        self.set(41,  (s.n2_ls  >> 8 ) & 0xff)
+        self.set(42,  (s.n2_ls)        & 0xff)
+        self.set(43,  (s.n31    >> 16))
+        self.set(44,  (s.n31    >> 8 ) & 0xff)
+        self.set(45,  (s.n31)          & 0xff)
+        self.set(46,  (s.n32    >> 16))
+        self.set(47,  (s.n32    >> 8 ) & 0xff)
+        self.set(48,  (s.n32)          & 0xff)
+        self.update(137, 0x01, 0x01)  # FASTLOCK=1
+        self.flush()
+        self.write(136, 0x40)  # ICAL=1, last
+        del self.regs[136]  # self-clearing
 
         if not self.has_xtal():
             raise ValueError("Si5324 misses XA/XB oscillator signal")
@@ -199,10 +671,9 @@ class Si5324:
         self.wait_lock()
 
     def dump(self):
-        for i in (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 19, 20, 21, 22, 23, 24,
-                25, 31, 32, 33, 34, 35, 36, 40, 41, 42, 43, 44, 45, 46, 47, 48,
-                55, 131, 132, 137, 138, 139, 142, 143, 136):
-            print("{: 4d}, {:02X}h".format(i, self.read(i)))
+        self.load(self.registers)
+        for i in self.registers:
+            print("{: 4d}, {:02X}h".format(i, self.regs[i]))
 
     def report(self):
         logger.info("SI5324(DCXO): has_xtal: %s, has_clkin1: %s, "
@@ -212,20 +683,68 @@ class Si5324:
 
 
 class EEPROM:
-    def __init__(self, bus, addr=0x50, pagesize=8):
+    t_wr = 5e-3  # write cycle time
+    # images by EUI-48, persisted in `cache_dir` if it exists
+    cache = {}
+    cache_dir = "eeprom"
+
+    def __init__(self, bus, addr=0x50, pagesize=None):
         self.bus = bus
         self.addr = addr
-        self.pagesize = pagesize
-
-    def dump(self):
-        return bytes(self.bus.read_many(self.addr, 0, 1 << 8))
+        self.pagesize = pagesize  # None: probed by `update()`
+
+    def cache_key(self, eui48=None):
+        return self.fmt_eui48(eui48)
+
+    def invalidate(self, key=None):
+        """Drop the cached image"""
+        if key is None:
+            key = self.cache_key()
+        self.cache.pop(key, None)
+        fil = os.path.join(self.cache_dir, key + ".bin")
+        if os.path.exists(fil):
+            os.unlink(fil)
+
+    def cached(self, key):
+        image = self.cache.get(key)
+        fil = os.path.join(self.cache_dir, key + ".bin")
+        if image is None and os.path.exists(fil):
+            with open(fil, "rb") as f:
+                image = f.read()
+        return image
+
+    def store(self, key, image):
+        self.cache[key] = image
+        if os.path.isdir(self.cache_dir):
+            with open(os.path.join(self.cache_dir, key + ".bin"), "wb") as f:
+                f.write(image)
+
+    def dump(self, cached=True):
+        """Read the memory through the image cache
+
+        The image is found by the EUI-48, the writable lower half is
+        re-read unless the Sinara CRC and magic match.
+        """
+        if not cached:
+            return bytes(self.bus.read_many(self.addr, 0, 1 << 8))
+        eui48 = bytes(self.eui48())
+        key = self.cache_key(eui48)
+        image = self.cached(key)
+        if image is not None and eui48 == image[0xfa:]:
+            head = bytes(self.bus.read_many(self.addr, 0, 6))
+            if head == image[:6] and head[4:] == struct.pack(
+                    ">H", Sinara._magic):
+                return image
+            image = bytes(self.bus.read_many(self.addr, 0, 0x80)
+                          ) + image[0x80:]
+        else:
+            image = self.dump(cached=False)
+        self.store(key, image)
+        return image
 
     def poll(self, timeout=1.):
-        t = time.monotonic()
-        while not self.bus.poll(self.addr, write=True):
-            if time.monotonic() - t > timeout:
-                raise ValueError("poll timeout")
-        logger.debug("polling took %g s", time.monotonic() - t)
+        wait(lambda: self.bus.poll(self.addr, write=True), "eeprom write",
+             self.t_wr, timeout, self.bus)
 
     def eui48(self):
         return self.bus.read_many(self.addr, 0xfa, 6)
@@ -238,13 +757,81 @@ class EEPROM:
             eui48 = self.eui48()
         return "{:02x}-{:02x}-{:02x}-{:02x}-{:02x}-{:02x}".format(*eui48)
 
-    def write(self, addr, data):
-        assert addr & (self.pagesize - 1) == 0
-        for i in range(0, len(data), self.pagesize):
+    def write(self, addr, data, key=None):
+        """Write `data` in pages, `key` is the cache key if known"""
+        self.invalidate(key)
+        pagesize = self.pagesize or 8
+        assert addr & (pagesize - 1) == 0
+        for i in range(0, len(data), pagesize):
             self.bus.write_many(self.addr, addr + i,
-                    data[i:i + self.pagesize])
+                    data[i:i + pagesize])
             self.poll()
 
+    def probe_pagesize(self, addr, block):
+        """Write a 16 byte `block` with differing halves at a 16 byte
+        aligned `addr` to find the page size. With 8 byte pages the second
+        half wraps onto the first one."""
+        assert addr & 15 == 0 and len(block) == 16 and block[:8] != block[8:]
+        self.bus.write_many(self.addr, addr, block)
+        self.poll()
+        readback = bytes(self.bus.read_many(self.addr, addr, 16))
+        self.pagesize = 16 if readback == block else 8
+        logger.debug("page size %d", self.pagesize)
+        return self.pagesize
+
+    def update(self, addr, data):
+        """Write the 8 byte chunks of `data` that differ from the current
+        contents, verify them and return the number of bytes written
+
+        The current contents are read, a cached image (`dump()`) is only
+        checked by its head and may be stale. An unknown page size is
+        probed on a dirty block.
+        """
+        assert addr & 7 == 0
+        data = bytes(data)
+        old = bytes(self.bus.read_many(self.addr, addr, len(data)))
+        dirty = {i for i in range(0, len(data), 8)
+                 if data[i:i + 8] != old[i:i + 8]}
+        if not dirty:
+            return 0
+        written = 0
+        if self.pagesize is None:
+            for i in range(-addr % 16, len(data) - 15, 16):
+                if ({i, i + 8} & dirty and
+                        data[i:i + 8] != data[i + 8:i + 16]):
+                    written += 16
+                    if self.probe_pagesize(addr + i, data[i:i + 16]) == 16:
+                        dirty -= {i, i + 8}
+                    else:
+                        dirty.add(i)  # overwritten by the wrap
+                    break
+            else:
+                self.pagesize = 8
+        # bursts from the first to the last dirty chunk within a page
+        bursts = []
+        for i in sorted(dirty):
+            if bursts and ((addr + i) // self.pagesize ==
+                           (addr + bursts[-1][0]) // self.pagesize):
+                bursts[-1][1] = i + 8
+            else:
+                bursts.append([i, i + 8])
+        for start, end in bursts:
+            self.bus.write_many(self.addr, addr + start, data[start:end])
+            self.poll()
+            written += end - start
+        # verify the touched chunks in contiguous reads
+        for start, length in runs(i//8 for i in dirty):
+            start, end = 8*start, 8*(start + length)
+            readback = bytes(self.bus.read_many(
+                self.addr, addr + start, end - start))
+            if readback != data[start:end]:
+                raise ValueError("verify failed", addr + start, readback)
+        key = self.cache_key()
+        image = self.cached(key)
+        if image is not None:
+            self.store(key, image[:addr] + data + image[addr + len(data):])
+        return written
+
     def report(self):
         logger.info("24C0x(EEPROM): EUI48: %s", self.fmt_eui48())
 
@@ -266,10 +853,115 @@ class PCF8574:
 
 
 class SFF8472:
-    def __init__(self, bus):
+    """SFP module memory map, A0h ID page and A2h diagnostics page
+
+    The static A0h page and the A2h thresholds and calibration are decoded
+    once per module (`identify()`, cached by serial number and date code),
+    `sample()` then only reads the live diagnostics and flags.
+    """
+    # static data by (serial, date code)
+    cache = {}
+    # diagnostics, in order of thresholds, samples and flags
+    quantities = ("temperature", "vcc", "tx_bias", "tx_power", "rx_power")
+    # scale to C, V, A, W
+    scale = (1/256, 100e-6, 2e-6, .1e-6, .1e-6)
+    # A2h byte 110
+    status_bits = {7: "tx_disable", 6: "soft_tx_disable", 2: "tx_fault",
+                   1: "rx_los", 0: "data_not_ready"}
+
+    def __init__(self, bus, addr=0x50):
         self.bus = bus
-        self.addr = 0x50
-        self.addr1 = 0x51
+        self.addr = addr
+        self.addr1 = addr + 1
+        self.info = None
+
+    @staticmethod
+    def decode_id(c):
+        """A0h serial ID fields"""
+        def text(a, b):
+            return bytes(c[a:b]).decode("ascii", "replace").strip(" \x00")
+        return dict(
+            identifier=c[0], connector=c[2],
+            transceiver=bytes(c[3:11]).hex(), encoding=c[11],
+            br_nominal=c[12]*100e6, rate_id=c[13],
+            length_smf_km=c[14], length_om2=c[16]*10, length_om1=c[17]*10,
+            length_cu=c[18], vendor=text(20, 36),
+            oui=bytes(c[37:40]).hex(), part=text(40, 56), rev=text(56, 60),
+            wavelength=c[60] << 8 | c[61], options=c[64] << 8 | c[65],
+            serial=text(68, 84), date=text(84, 92),
+            ddm=bool(c[92] & 0x40), internal=bool(c[92] & 0x20),
+            external=bool(c[92] & 0x10), average=bool(c[92] & 0x08),
+            address_change=bool(c[92] & 0x04), enhanced=c[93],
+            compliance=c[94],
+            checksum=c[63] == sum(c[:63]) & 0xff and
+            c[95] == sum(c[64:95]) & 0xff)
+
+    @staticmethod
+    def decode_calibration(d):
+        """A2h external calibration constants"""
+        rx_pwr = struct.unpack(">5f", bytes(d[56:76]))[::-1]  # (0)...(4)
+        slope_offset = struct.unpack(">HhHhHhHh", bytes(d[76:92]))
+        # slopes are unsigned 8.8 fixed point
+        tx_bias, tx_pwr, t, vcc = [
+            (slope_offset[i]/256, slope_offset[i + 1]) for i in range(0, 8, 2)]
+        return dict(rx_power=rx_pwr, tx_bias=tx_bias, tx_power=tx_pwr,
+                    temperature=t, vcc=vcc)
+
+    def calibrate(self, raw):
+        """Raw A/D values (temperature, vcc, tx_bias, tx_power, rx_power)
+        to SI units"""
+        cal = self.info["calibration"]
+        if cal is not None:
+            raw = list(raw)
+            for i, q in enumerate(self.quantities[:4]):
+                slope, offset = cal[q]
+                raw[i] = slope*raw[i] + offset
+            raw[4] = sum(c*raw[4]**i for i, c in enumerate(cal["rx_power"]))
+        return {q: v*s for q, v, s in zip(self.quantities, raw, self.scale)}
+
+    def identify(self):
+        """Decode the static pages, once per module"""
+        key = bytes(self.bus.read_many(self.addr, 68, 24))
+        info = self.cache.get(key)
+        if info is None:
+            self.info = info = self.decode_id(
+                self.bus.read_many(self.addr, 0, 96))
+            info["calibration"] = None
+            info["thresholds"] = None
+            if info["ddm"]:
+                d = self.bus.read_many(self.addr1, 0, 96)
+                if info["external"]:
+                    info["calibration"] = self.decode_calibration(d)
+                th = struct.unpack(">hhhh" + "HHHH"*4, bytes(d[:40]))
+                # high alarm, low alarm, high warning, low warning
+                levels = [self.calibrate(th[j::4]) for j in range(4)]
+                info["thresholds"] = {q: tuple(level[q] for level in levels)
+                                      for q in self.quantities}
+            self.cache[key] = info
+        self.info = info
+        return info
+
+    def sample(self, flags=True):
+        """Read the live diagnostics (10 bytes), and with `flags` the
+        status, alarm and warning flags (22 bytes)"""
+        if self.info is None:
+            self.identify()
+        if not self.info["ddm"]:
+            raise ValueError("no digital diagnostics", self.info["part"])
+        d = bytes(self.bus.read_many(self.addr1, 96, 22 if flags else 10))
+        ret = self.calibrate(struct.unpack(">hHHHH", d[:10]))
+        if flags:
+            status = d[14]
+            ret.update((name, bool(status & (1 << bit)))
+                       for bit, name in self.status_bits.items())
+            for kind, (a, b) in ("alarm", d[16:18]), ("warning", d[20:22]):
+                bits = a << 8 | b
+                ret[kind] = [
+                    "{}_{}".format(q, level)
+                    for i, q in enumerate(self.quantities)
+                    for j, level in enumerate(("high", "low"))
+                    if bits & (1 << (15 - 2*i - j))]
+        return ret
 
     def dump(self):
         c = self.bus.read_many(self.addr, 0, 256)
@@ -284,50 +976,80 @@ class SFF8472:
                     *dump[j*16:(j + 1)*16])
 
     def watch(self, n=10):
+        import numpy as np
         b = self.dump()
         for i in b:
             self.print_dump(i)
+        b = np.frombuffer(b"".join(map(bytes, b)), np.uint8).reshape(2, -1)
         for i in range(n):
-            b, b0 = self.dump(), b
-            for j, (c0, c) in enumerate(zip(b0, b)):
-                for k, (a0, a) in enumerate(zip(c0, c)):
-                    if a0 == a:
-                        continue
-                    logger.warning("run % 2i, idx %i/%#02x(%3i): "
-                                   "%#02x != %#02x", i, j, k, k, a0, a)
+            b, b0 = np.frombuffer(b"".join(map(bytes, self.dump())),
+                                  np.uint8).reshape(2, -1), b
+            for j, k in zip(*np.nonzero(b != b0)):
+                logger.warning("run % 2i, idx %i/%#02x(%3i): "
+                               "%#02x != %#02x", i, j, k, k, b0[j, k],
+                               b[j, k])
 
     def report(self):
         if self.bus.read_many(self.addr, 63, 1) in b"\x00\xff":
             logger.debug("invalid SFF CC_BASE, ignoring")
             return
-        c, d = self.dump()
+        info = self.identify()
         logger.info("SFF8472(SFP): vendor: %s, part: %s, serial: %s",
-                c[20:35].strip(), c[40:40+16].strip(), c[68:68+16].strip())
-        logger.info("OUI: %s", c[37:40])
-        if c[92] & 0x40:
+                    info["vendor"], info["part"], info["serial"])
+        logger.info("OUI: %s", info["oui"])
+        if info["ddm"]:
             logger.info("Digital diagnostics implemented")
-        if c[92] & 0x04:
+        if info["address_change"]:
             logger.info("Address change sequence required")
-        if c[92] & 0x08:
+        if info["average"]:
             logger.info("Received power is average power")
-        if c[92] & 0x10:
+        if info["external"]:
             logger.info("Externally calibrated")
-        if c[92] & 0x20:
+        if info["internal"]:
             logger.info("Internally calibrated")
-            t, vcc, tx_bias, tx_pwr, rx_pwr = struct.unpack(
-                    ">hHHHH", d[96:106])
-            logger.info("Temperature %s C", t/256)
-            logger.info("VCC %s V", vcc*100e-6/256)
-            logger.info("TX %s mA, %s µW", tx_bias*2e-3/256, tx_pwr*.1/256)
-            logger.info("RX %s µW", rx_pwr*.1/256)
+        if info["ddm"]:
+            d = self.sample()
+            logger.info("Temperature %s C", d["temperature"])
+            logger.info("VCC %s V", d["vcc"])
+            logger.info("TX %s mA, %s µW", d["tx_bias"]*1e3,
+                        d["tx_power"]*1e6)
+            logger.info("RX %s µW", d["rx_power"]*1e6)
+            logger.info("alarms: %s, warnings: %s", d["alarm"],
+                        d["warning"])
 
 
 class LM75:
     """Temperature sensor with overtemp shutdown output"""
+    # config and thresholds by location, see `limits()`
+    cache = {}
+
     def __init__(self, bus, addr=0x48):
         self.bus = bus
         self.addr = addr
 
+    def cache_key(self):
+        mux = getattr(self.bus, "mux", None)
+        key = "{}_{}_{:02x}".format(getattr(self.bus, "url", ""),
+                                    mux.paths if mux else "", self.addr)
+        return re.sub(r"\W+", "_", key).strip("_")
+
+    def limits(self, cached=True):
+        """Config, hysteresis and shutdown temperature, read once"""
+        key = self.cache_key()
+        if not cached or key not in self.cache:
+            self.cache[key] = dict(
+                config=self.bus.read_many(self.addr, 0x01, 1)[0],
+                hysteresis=self.get_hysteresis(),
+                shutdown=self.get_shutdown())
+        return self.cache[key]
+
+    def sample(self):
+        """Temperature, with the cached limits"""
+        t = self.get_temperature()
+        limits = self.limits()
+        return dict(limits, temperature=t,
+                    overtemp=t >= limits["shutdown"])
+
     def get_temperature(self):
         return self.mu_to_temp(self.bus.read_many(self.addr, 0x00, 2))
 
@@ -338,9 +1060,11 @@ class LM75:
         return self.mu_to_temp(self.bus.read_many(self.addr, 0x03, 2))
 
     def set_hysteresis(self, t):
+        self.cache.pop(self.cache_key(), None)
         self.bus.write_many(self.addr, 0x02, self.temp_to_mu(t))
 
     def set_shutdown(self, t):
+        self.cache.pop(self.cache_key(), None)
         self.bus.write_many(self.addr, 0x03, self.temp_to_mu(t))
 
     def mu_to_temp(self, t):
@@ -354,6 +1078,7 @@ class LM75:
             interrupt=0, shutdown=0):
         cfg = ((fault_queue << 3) | (os_polarity << 2) |
                 (interrupt << 1) | (shutdown << 0))
+        self.cache.pop(self.cache_key(), None)
         self.bus.write_many(self.addr, 0x01, [cfg])
 
     def get_config(self):
@@ -374,23 +1099,28 @@ class SPI:
         self.bus = bus
         self.addr = addr
         self.max_buffer = 200
+        self.f_spi = 1843e3
+        self.pending = 0
+        self.gpio = {}  # last written GPIO registers by function ID
+        self.gpio_in = None  # last GPIO sample
 
     def poll(self, timeout=.1):
-        t = time.monotonic()
-        while not self.clear_interrupt():
-            if time.monotonic() - t > timeout:
-                raise ValueError("poll timeout")
-        logger.debug("polling took %g s", time.monotonic() - t)
+        # SPI transfer time of the pending bytes plus command decoding
+        hint = 8*self.pending/self.f_spi + 20e-6
+        self.pending = 0
+        wait(self.clear_interrupt, "spi xfer", hint, timeout, self.bus)
 
     def spi_write(self, ss, data, read=False):
         assert len(data) <= self.max_buffer
         self.bus.write_many(self.addr, ss, data)
+        self.pending = len(data)
 
     def buffer_read(self, length):
         return self.bus.read_stream(self.addr, length)
 
     def configure(self, order=0, mode=0, f=0):
         self.bus.write_many(self.addr, 0xf0, [(order << 5) | (mode << 2) | f])
+        self.f_spi = 7.3728e6/(4, 16, 64, 128)[f]
 
     def clear_interrupt(self):
         try:
@@ -402,28 +1132,108 @@ class SPI:
     def idle(self):
         self.bus.write_single(self.addr, 0xf2)
 
+    def gpio_invalidate(self):
+        """Forget the cached GPIO state (e.g. after a bridge reset)"""
+        self.gpio = {}
+
+    def _gpio_set(self, function, value):
+        # write a GPIO register unless it already holds the value
+        if self.gpio.get(function) == value:
+            return
+        self.bus.write_many(self.addr, function, [value])
+        self.gpio[function] = value
+
     def gpio_write(self, gpio):
-        self.bus.write_many(self.addr, 0xf4, [gpio])
+        self._gpio_set(0xf4, gpio)
 
     def gpio_read(self):
         self.bus.write_many(self.addr, 0xf5, [0])
-        return self.buffer_read(1)[0]
+        self.gpio_in = self.buffer_read(1)[0]
+        return self.gpio_in
 
     def gpio_enable(self, gpio):
-        self.bus.write_many(self.addr, 0xf6, [gpio])
+        self._gpio_set(0xf6, gpio)
 
     def gpio_config(self, *ss):
         """quasi-bidir, push-pull, input, open-drain"""
         cfg = sum((ssi << (2*i) for i, ssi in enumerate(ss)), 0)
         logger.info("gpio config %#02x", cfg)
-        self.bus.write_many(self.addr, 0xf7, [cfg])
+        self._gpio_set(0xf7, cfg)
+
+    def gpio_check(self, mask, value):
+        """Check all `mask` bits against `value` from one GPIO sample"""
+        i = self.gpio_read()
+        if (i ^ value) & mask:
+            raise ValueError("GPIO state mismatch", hex(i), hex(mask),
+                             hex(value))
+        return i
+
+    def gpio_write_verify(self, gpio, mask):
+        """Write the outputs and check the `mask` pins read back as written"""
+        self.gpio_write(gpio)
+        return self.gpio_check(mask, gpio)
+
+    def gpio_wait(self, mask, value, op, hint, timeout):
+        """Wait for the `mask` pins to read `value`, one sample per poll"""
+        return wait(lambda: not (self.gpio_read() ^ value) & mask,
+                    op, hint, timeout, self.bus)
+
+
+@contextmanager
+def flash_manifest(fil):
+    """Sector hash manifest for `SPIFlash.program()`, kept in a JSON file"""
+    manifest = {}
+    if os.path.exists(fil):
+        with open(fil) as f:
+            manifest = json.load(f)
+    try:
+        yield manifest
+    finally:
+        with open(fil, "w") as f:
+            json.dump(manifest, f, indent=1)
+
+
+# erase: {size: (command, typical, max time)}, t_page: (typical, max),
+# f_read: highest clock for READ (0x03), FAST_READ (0x0b) above
+FlashPart = namedtuple("FlashPart", "name size erase t_page f_read addr4")
 
 
 class SPIFlash:  # SPI flash behind SC18IS602B I2C-to-SPI converter
+    page = 0x100
+    gap = 16  # shortest 0xff run worth splitting a page program
+    # by JEDEC ID, typical/max timings from the datasheets
+    parts = {
+        b"\xef\x40\x16": FlashPart("W25Q32", 4 << 20, {
+            0x1000: (0x20, 45e-3, .4), 0x8000: (0x52, .12, 1.6),
+            0x10000: (0xd8, .15, 2.)}, (.4e-3, 3e-3), 50e6, False),
+        b"\xef\x40\x17": FlashPart("W25Q64", 8 << 20, {
+            0x1000: (0x20, 45e-3, .4), 0x8000: (0x52, .12, 1.6),
+            0x10000: (0xd8, .15, 2.)}, (.4e-3, 3e-3), 50e6, False),
+        b"\xef\x40\x18": FlashPart("W25Q128", 16 << 20, {
+            0x1000: (0x20, 45e-3, .4), 0x8000: (0x52, .12, 1.6),
+            0x10000: (0xd8, .15, 2.)}, (.4e-3, 3e-3), 50e6, False),
+        b"\xef\x40\x19": FlashPart("W25Q256", 32 << 20, {
+            0x1000: (0x21, 45e-3, .4), 0x10000: (0xdc, .15, 2.)},
+            (.4e-3, 3e-3), 50e6, True),
+        b"\x20\xba\x16": FlashPart("N25Q032", 4 << 20, {
+            0x1000: (0x20, .25, .8), 0x10000: (0xd8, .7, 3.)},
+            (.5e-3, 5e-3), 54e6, False),
+        b"\x20\xba\x18": FlashPart("N25Q128", 16 << 20, {
+            0x1000: (0x20, .25, .8), 0x10000: (0xd8, .7, 3.)},
+            (.5e-3, 5e-3), 54e6, False),
+    }
+    # unknown parts: 64 KiB sector erase, conservative timing
+    default = FlashPart("unknown", None, {0x10000: (0xd8, .15, 3.)},
+                        (.7e-3, 5e-3), 20e6, False)
+    # 4 byte address commands
+    addr4 = {0x03: 0x13, 0x0b: 0x0c, 0x02: 0x12}
+    dump_length = 0x22000  # for parts of unknown size
+
     def __init__(self, bus, ss, sector=0x10000):
         self.ss = ss  # slave select bit mask
         self.bus = bus
-        self.sector = sector
+        self.sector = sector  # smallest erase, set by `identify()`
+        self.part = None
 
     def xfer(self, data, read=False):
         self.bus.spi_write(self.ss, data)
@@ -432,17 +1242,29 @@ class SPIFlash:  # SPI flash behind SC18IS602B I2C-to-SPI converter
             return self.bus.buffer_read(len(data))
 
     def cmd(self, cmd, offset=0):
+        if self.part is not None and self.part.addr4:
+            return bytes([self.addr4.get(cmd, cmd)]) + offset.to_bytes(4, "big")
         return bytes([cmd, offset >> 16, (offset >> 8) & 0xff, offset & 0xff])
 
     def read_identification(self):
-        return self.xfer(self.cmd(0x9f), read=True)[1:]
+        return self.xfer([0x9f, 0, 0, 0], read=True)[1:]
+
+    def identify(self):
+        """Look up the part by JEDEC ID"""
+        if self.part is None:
+            jedec = bytes(self.read_identification())
+            self.part = self.parts.get(jedec, self.default)
+            self.sector = min(self.part.erase)
+            logger.info("flash %s: %s", jedec.hex(), self.part.name)
+        return self.part
 
     def read_status(self):
         return self.xfer([0x05, 0xff], read=True)[1]
 
-    def write_enable(self):
+    def write_enable(self, check=True):
         self.xfer([0x06])
-        assert self.read_status() & 2  # WE
+        if check:
+            assert self.read_status() & 2  # WE
 
     def write_disable(self):
         self.xfer([0x04])
@@ -454,42 +1276,214 @@ class SPIFlash:  # SPI flash behind SC18IS602B I2C-to-SPI converter
     def power_down(self):
         self.xfer([0xb9])
 
-    def poll(self, timeout=4.):
-        t = time.monotonic()
-        while self.read_status() & 1:  # busy
-            if time.monotonic() - t > timeout:
-                raise ValueError("busy timeout")
-        logger.debug("busy for %g s", time.monotonic() - t)
+    def poll(self, op="flash busy", hint=1e-3, timeout=4.):
+        wait(lambda: not self.read_status() & 1, op, hint, timeout,
+             self.bus.bus)
 
     def read_data_bytes(self, offset, length):
-        return self.xfer(self.cmd(0x03, offset) + bytes(length), read=True)[4:]
+        part = self.part or self.default
+        if getattr(self.bus, "f_spi", 0) > part.f_read:
+            cmd = self.cmd(0x0b, offset) + b"\x00"  # dummy byte
+        else:
+            cmd = self.cmd(0x03, offset)
+        return self.xfer(cmd + bytes(length), read=True)[len(cmd):]
+
+    def erase(self, offset, size):
+        cmd, t_typ, t_max = (self.part or self.default).erase[size]
+        assert offset & (size - 1) == 0
+        self.xfer(self.cmd(cmd, offset))
+        self.poll("flash erase {:#x}".format(size), t_typ, 2*t_max)
 
     def sector_erase(self, offset):
-        self.xfer(self.cmd(0xd8, offset))
-        self.poll()
+        self.erase(offset, 0x10000)
 
     def page_program(self, offset, data):
+        t_typ, t_max = (self.part or self.default).t_page
         self.xfer(self.cmd(0x02, offset) + data)
-        self.poll()
-
-    def flash(self, offset, data, verify=True):
-        n = 128  # self.bus.max_buffer - 4 will cross page boundary
+        self.poll("flash program", t_typ, 2*t_max)
+
+    def read(self, offset, length):
+        """Read in transfers filling the SPI buffer"""
+        n = self.bus.max_buffer - len(self.cmd(0x0b)) - 1
+        return b"".join(
+            self.read_data_bytes(addr, min(n, offset + length - addr))
+            for addr in range(offset, offset + length, n))
+
+    def chunks(self, offset, data):
+        """Page program (offset, data) for all non-0xff bytes, not crossing
+        pages and filling the SPI buffer"""
+        assert offset & (self.page - 1) == 0
+        n = self.bus.max_buffer - len(self.cmd(0x02))
+        for start in range(0, len(data), self.page):
+            end = min(start + self.page, len(data))
+            spans = []
+            for m in re.finditer(rb"[^\xff]+", data[start:end]):
+                if spans and m.start() - spans[-1][1] < self.gap:
+                    spans[-1][1] = m.end()
+                else:
+                    spans.append([m.start(), m.end()])
+            for i, j in spans:
+                for k in range(start + i, start + j, n):
+                    yield offset + k, data[k:min(k + n, start + j)]
+
+    def erase_cover(self, blocks):
+        """(offset, size) erases covering exactly the `sector` blocks,
+        largest first"""
+        todo = set(blocks)
+        erases = []
+        for size in sorted((self.part or self.default).erase, reverse=True):
+            for start in sorted({block & ~(size - 1) for block in todo}):
+                sub = set(range(start, start + size, self.sector))
+                if sub <= todo:
+                    erases.append((start, size))
+                    todo -= sub
+        assert not todo
+        return sorted(erases)
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def program(self, offset, data, manifest=None, verify=True):
+        """Program `data` in erase blocks, skip unchanged blocks
+
+        `manifest` (updated in place, see `flash_manifest()`) holds the
+        hashes of the blocks on the flash as last read or written. A block
+        with a matching hash there is skipped without reading, one with a
+        different hash is erased and rewritten. The other blocks are read
+        first and skipped if their hash matches. Blocks are not erased if
+        the readback only needs bits cleared, the others are erased with
+        the largest erase commands that cover only them. All-0xff runs are
+        not programmed. With `verify`, the written blocks are read back
+        again. Returns the number of blocks written. See `program_steps()`
+        for a preemptible variant.
+        """
+        return drain(self.program_steps(offset, data, manifest, verify))
+
+    def program_steps(self, offset, data, manifest=None, verify=True):
+        """`program()` as a generator yielding after every block read,
+        erase and page program, e.g. for `executor.BusExecutor` jobs"""
+        self.identify()
         assert offset & (self.sector - 1) == 0
-        for addr in range(offset, offset + len(data), n):
-            if not addr & (self.sector - 1):
-                self.write_enable()
-                self.sector_erase(addr)
-            self.write_enable()
-            write = data[addr - offset:addr - offset + n]
-            self.page_program(addr, write)
-            logger.info("wrote %#06x bytes at %#06x", offset + len(write), addr)
-            if verify:
-                read = self.read_data_bytes(addr, len(write))
-                if write != read:
-                    raise RuntimeError("verify failed at %#06x: "
-                                       "write %r != read %r",
-                                        hex(addr), write, read)
+        images = {}
+        erase = []
+        for addr in range(offset, offset + len(data), self.sector):
+            new = data[addr - offset:addr - offset + self.sector]
+            digest = self.digest(new)
+            key = "{:#x}".format(addr)
+            known = None if manifest is None else manifest.get(key)
+            if known == digest:
+                continue
+            if known is not None:
+                erase.append(addr)
+                images[addr] = new
+                continue
+            old = self.read(addr, len(new))
+            yield
+            if self.digest(old) == digest:
+                if manifest is not None:
+                    manifest[key] = digest
+                continue
+            if (int.from_bytes(old, "big") &
+                    int.from_bytes(new, "big")) == int.from_bytes(new, "big"):
+                # only clear bits, program the differing bytes in place
+                new_old = zip(new, old)
+                images[addr] = bytes(n if n != o else 0xff for n, o in new_old)
+            else:
+                erase.append(addr)
+                images[addr] = new
+        if manifest is not None:
+            # unknown until written and verified
+            for addr in images:
+                manifest.pop("{:#x}".format(addr), None)
+        for addr, size in self.erase_cover(erase):
+            self.write_enable(check=False)
+            self.erase(addr, size)
+            yield
+        for addr, image in sorted(images.items()):
+            for i, chunk in self.chunks(addr, image):
+                self.write_enable(check=False)
+                self.page_program(i, chunk)
+                yield
+            new = data[addr - offset:addr - offset + self.sector]
+            digest = self.digest(new)
+            if verify and self.digest(self.read(addr, len(new))) != digest:
+                raise ValueError("verify failed", hex(addr))
+            if manifest is not None:
+                manifest["{:#x}".format(addr)] = digest
+            logger.info("wrote %#06x bytes at %#06x", len(new), addr)
+            yield
         self.write_disable()
+        return len(images)
+
+    def flash(self, offset, data, verify=True):
+        return self.program(offset, data, verify=verify)
+
+    def dump(self, fil, offset=0, length=None, blank=0x10000,
+             checkpoint=0x2000):
+        """Stream the flash contents into the memory mapped file `fil`
+
+        Progress is checkpointed every `checkpoint` bytes to `fil.part`,
+        an interrupted dump resumes there. The length defaults to the flash
+        size, `dump_length` for unknown parts. Reading stops after `blank`
+        0xff bytes and trailing erased sectors are not kept (`blank=None`
+        reads and keeps everything). Returns the length and SHA-256 of the
+        data.
+        """
+        self.identify()
+        if length is None:
+            if self.part.size is None:
+                length = self.dump_length
+            else:
+                length = self.part.size - offset
+        if length <= 0:
+            open(fil, "wb").close()
+            return 0, hashlib.sha256().hexdigest()
+        clock = getattr(self.bus.bus, "time", time.monotonic)
+        state = fil + ".part"
+        done = 0
+        if os.path.exists(state) and os.path.exists(fil):
+            with open(state) as f:
+                st = json.load(f)
+            if (st["offset"], st["length"]) == (offset, length):
+                done = st["done"]
+                logger.info("resuming at %#x", offset + done)
+        n = self.bus.max_buffer - len(self.cmd(0x0b)) - 1
+        with open(fil, "r+b" if done else "w+b") as f:
+            f.truncate(length)
+            with mmap.mmap(f.fileno(), length) as m:
+                end = done if blank is None else len(m[:done].rstrip(b"\xff"))
+                h = hashlib.sha256(m[:end])
+                t0, start = clock(), done
+                while done < length:
+                    k = min(n, length - done)
+                    m[done:done + k] = self.read_data_bytes(offset + done, k)
+                    done += k
+                    new = done if blank is None else len(
+                        m[end:done].rstrip(b"\xff")) + end
+                    if new > end:
+                        h.update(m[end:new])
+                        end = new
+                    if blank is not None and done - end >= blank:
+                        break
+                    if done % checkpoint < k or done == length:
+                        m.flush()
+                        with open(state, "w") as fs:
+                            json.dump(dict(offset=offset, length=length,
+                                           done=done), fs)
+                        logger.info("read %#x/%#x, %.0f B/s", done, length,
+                                    (done - start)/max(clock() - t0, 1e-9))
+                if blank is not None:
+                    # keep the sector of the last data, it may end in 0xff
+                    sector = -(-(offset + end)//self.sector)*self.sector
+                    keep = min(sector - offset, done)
+                    h.update(m[end:keep])
+                    end = keep
+                m.flush()
+            f.truncate(end)
+        if os.path.exists(state):
+            os.remove(state)
+        return end, h.hexdigest()
 
 
 class SinaraEEPROM(EEPROM):
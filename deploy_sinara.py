@@ -71,84 +71,118 @@ def get_sinara_label(s):
 ^XZ""".format(s=s, date=today)
 
 
-def flash(description, ss, ft_serial=None):
-    ss_new = []
-    url = "ftdi://ftdi:4232h{}/2".format(
-            ":" + ft_serial if ft_serial is not None else "")
-
-    from kasli import Kasli
-    from chips import EEPROM, PCA9548
-
-    with Kasli().configure(url) as bus:
-        # bus.reset_switch()
-        bus.reset()
-        try:
-            for i, s in enumerate(ss):
-                ss_new.append([])
-                for j, si in enumerate(s):
-                    ee = EEPROM(bus)
-                    if i == 0:
-                        port = "LOC0"
-                        if (si.board_fmt, si.hw_rev) in [
-                            ("Kasli", "v2.0"),
-                            ("Kasli_soc", "v1.0"),
-                            # ...
-                        ]:
-                            ee = EEPROM(bus, addr=0x57)  # Kasli v2 and Kasli-SoC have this address
-                    else:
-                        port = "EEM{:d}".format(
-                            description["peripherals"][i - 1]["ports"][j])
-                        if description["peripherals"][i - 1]["type"] in "banker humpback".split():
-                            continue
-                            PCA9548(bus, addr=0x72).set(0b0)  # no eeprom
-                    logger.info("%s", port)
-                    bus.enable(port)  # TODO: Banker, Humpback switch
-                    eui48 = ee.eui48()
-                    if si.eui48 not in (eui48, si._defaults.eui48):
-                        logger.warning("eui48 mismatch, %s->%s", si.eui48, eui48)
-                    new = si._replace(eui48=eui48)
-                    old = None
-                    try:
-                        old = Sinara.unpack(ee.dump())
-                        logger.debug("old data: valid data %s", old)
-                        # don't touch data fields
-                        new = new._replace(
-                            project_data=old.project_data,
-                            board_data=old.board_data,
-                            user_data=old.user_data
-                        )
-                        # don't touch eeprom if valid other vendor
-                        if old.vendor not in (0x00, 0xff, new.vendor):
-                            logger.info("old data: existing vendor data, skipping update")
-                            new = old
-                        if new != old:
-                            old_dict = old._asdict()
-                            new_dict = new._asdict()
-                            logger.info("change data: %s", ", ".join(
-                                "{}: {}->{}".format(
-                                    k, old_dict[k], new_dict[k])
-                                for k in old._fields
-                                if old_dict[k] != new_dict[k]))
-                    except:
-                        logger.info("old data: invalid", exc_info=True)
-                    if new == old:
-                        logger.info("new data: unchanged, skipping update")
-                    else:
-                        logger.info("writing %s", new)
-                        ee.write(0, new.pack()[:128])
-                        new_readback = ee.dump()
-                        try:
-                            Sinara.unpack(new_readback)
-                            logger.debug("data readback valid")
-                        except:
-                            logger.error("data readback invalid %r",
-                                         new_readback, exc_info=True)
-                    open("data/{}.bin".format(new.eui48_fmt), "wb"
-                         ).write(new.pack())
-                    ss_new[-1].append(new)
-
-        finally:
-            bus.enable()
+def locations(description, ss):
+    """EEPROM (port, addr) of each board in `ss`, None if not reachable"""
+    for i, s in enumerate(ss):
+        for j, si in enumerate(s):
+            addr = 0x50
+            if i == 0:
+                port = "LOC0"
+                if (si.board_fmt, si.hw_rev) in [
+                    ("Kasli", "v2.0"),
+                    ("Kasli_soc", "v1.0"),
+                    # ...
+                ]:
+                    addr = 0x57  # Kasli v2 and Kasli-SoC have this address
+            else:
+                port = "EEM{:d}".format(
+                    description["peripherals"][i - 1]["ports"][j])
+                if description["peripherals"][i - 1]["type"] in "banker humpback".split():
+                    # TODO: Banker, Humpback switch
+                    # PCA9548(bus, addr=0x72).set(0b0)  # no eeprom
+                    yield i, j, None
+                    continue
+            yield i, j, (port, addr)
+
+
+def read_sweep(bus, locs):
+    """Read the EEPROM images in one pass over the ports"""
+    from chips import EEPROM
+
+    images = {}
+    for port, addr in sorted(locs, key=lambda loc: bus.ports[loc[0]]):
+        logger.info("%s", port)
+        bus.enable(port)
+        images[(port, addr)] = EEPROM(bus, addr).dump()
+    return images
+
+
+def plan(si, image):
+    """New Sinara data for a board and the changed fields"""
+    eui48 = image[0xfa:]
+    if si.eui48 not in (eui48, si._defaults.eui48):
+        logger.warning("eui48 mismatch, %s->%s", si.eui48, eui48)
+    new = si._replace(eui48=eui48)
+    old = None
+    try:
+        old = Sinara.unpack(image)
+        logger.debug("old data: valid data %s", old)
+        # don't touch data fields
+        new = new._replace(
+            project_data=old.project_data,
+            board_data=old.board_data,
+            user_data=old.user_data
+        )
+        # don't touch eeprom if valid other vendor
+        if old.vendor not in (0x00, 0xff, new.vendor):
+            logger.info("old data: existing vendor data, skipping update")
+            new = old
+    except:
+        logger.info("old data: invalid", exc_info=True)
+    if old is None:
+        return new, {k: (None, v) for k, v in new._asdict().items()}
+    old_dict = old._asdict()
+    new_dict = new._asdict()
+    return new, {k: (old_dict[k], new_dict[k]) for k in old._fields
+                 if old_dict[k] != new_dict[k]}
+
+
+def flash(description, ss, ft_serial=None, bus=None, dry_run=False):
+    """Update the Sinara EEPROMs of the boards in `ss`
+
+    One read sweep collects the images, the changes are planned offline
+    and one write sweep touches only the boards that need them.
+    """
+    if bus is None:
+        url = "ftdi://ftdi:4232h{}/2".format(
+                ":" + ft_serial if ft_serial is not None else "")
+        from kasli import Kasli
+        with Kasli().configure(url) as bus:
+            return flash(description, ss, bus=bus, dry_run=dry_run)
+
+    from chips import EEPROM
+
+    locs = list(locations(description, ss))
+    ss_new = [[] for s in ss]
+    bus.reset()
+    try:
+        images = read_sweep(bus, [loc for i, j, loc in locs if loc])
+        writes = []
+        for i, j, loc in locs:
+            if loc is None:
+                continue
+            new, changes = plan(ss[i][j], images[loc])
+            if not changes:
+                logger.info("%s: unchanged, skipping update", loc[0])
+            else:
+                logger.info("%s: change data: %s", loc[0], ", ".join(
+                    "{}: {}->{}".format(k, *v) for k, v in changes.items()))
+                writes.append((loc, new))
+            ss_new[i].append(new)
+        if dry_run:
+            return ss_new
+        for (port, addr), new in sorted(
+                writes, key=lambda w: bus.ports[w[0][0]]):
+            logger.info("writing %s", new)
+            bus.enable(port)
+            n = EEPROM(bus, addr).update(0, new.pack()[:128])
+            logger.debug("%d bytes written and verified", n)
+        for s in ss_new:
+            for new in s:
+                open("data/{}.bin".format(new.eui48_fmt), "wb"
+                     ).write(new.pack())
+    finally:
+        bus.enable()
     return ss_new
 
 
@@ -159,6 +193,9 @@ if __name__ == "__main__":
     p = argparse.ArgumentParser()
     p.add_argument("-p", "--printer")
     p.add_argument("-u", "--update", action="store_true")
+    p.add_argument("-n", "--dry-run", action="store_true",
+                   help="print the EEPROM changes and the description "
+                   "without writing anything")
     p.add_argument("-s", "--serial")
     p.add_argument("-k", "--kasli", type=int, default=1)
     p.add_argument("-v", "--verbose", default=0, action="count")
@@ -179,7 +216,7 @@ if __name__ == "__main__":
     ss.extend(get_eem(p) for p in description["peripherals"])
 
     if args.update:
-        ss = flash(description, ss, args.serial)
+        ss = flash(description, ss, args.serial, dry_run=args.dry_run)
         for i, s in enumerate(ss):
             e = [si.eui48_fmt for si in s]
             if any(ei != Sinara._defaults.eui48_fmt for ei in e):
@@ -188,6 +225,10 @@ if __name__ == "__main__":
                     description.move_to_end("peripherals")
                 else:
                     description["peripherals"][i - 1]["eui48"] = e
+    if args.dry_run:
+        # no metadata, labels or printing
+        print(json.dumps(description, indent=4))
+        raise SystemExit
     with open("meta/{}.json".format(ss[0][0].eui48_fmt), "w") as f:
         f.write(json.dumps(description, indent=4))
 
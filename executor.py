@@ -0,0 +1,169 @@
+import logging
+import threading
+import heapq
+import itertools
+import asyncio
+import inspect
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+# job priorities, lower runs first
+INTERACTIVE = 0
+NORMAL = 10
+BULK = 20
+
+
+class Job:
+    def __init__(self, fn, ports, priority):
+        self.fn = fn
+        self.ports = ports
+        self.priority = priority
+        self.future = Future()
+
+
+class BusExecutor:
+    """Serialize all access to one `Kasli` bus in a worker thread
+
+    Jobs are callables `fn(bus)` run with the mux set to their `ports`.
+    They are submitted from threads (`submit()`, `call()`) or coroutines
+    (`run()`) and executed by priority, then in order. A job returning a
+    generator (e.g. `lambda bus: flash.program_steps(offset, data)`) is
+    preemptible: at each `yield` (between transactions) more urgent jobs
+    run first, and the mux paths of the preempted job are restored before
+    it resumes. Jobs changing switches
+    outside the `Kasli` mux tree (e.g. an on-board PCA9548) must restore
+    them before yielding.
+
+    Jobs may use `call()`, `read_many()` and `write_many()`, on the worker
+    thread these run directly. They must not wait for the Futures of
+    `submit()` or `transaction()`: those jobs only run after them.
+    """
+    def __init__(self, bus):
+        self.bus = bus
+        self.queue = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._work, daemon=True,
+                                       name="bus executor")
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, fn, *ports, priority=NORMAL):
+        """Queue `fn(bus)` with the mux set to `ports`, return a Future"""
+        job = Job(fn, ports, priority)
+        with self.cond:
+            if self.closed:
+                raise ValueError("executor closed")
+            heapq.heappush(self.queue, (priority, next(self.seq), job))
+            self.cond.notify()
+        return job.future
+
+    def call(self, fn, *ports, priority=NORMAL):
+        """Run `fn(bus)` and wait for the result
+
+        From a job `fn` runs immediately, waiting for a queued job on the
+        worker thread would deadlock.
+        """
+        if threading.current_thread() is self.thread:
+            return self._direct(fn, ports)
+        return self.submit(fn, *ports, priority=priority).result()
+
+    async def run(self, fn, *ports, priority=NORMAL):
+        """Run `fn(bus)` from a coroutine"""
+        return await asyncio.wrap_future(
+            self.submit(fn, *ports, priority=priority))
+
+    def transaction(self, ops, *ports, priority=NORMAL):
+        """Queue bus method calls `[(name, *args), ...]` as one job,
+        the Future result is the list of their results"""
+        def fn(bus):
+            return [getattr(bus, name)(*args) for name, *args in ops]
+        return self.submit(fn, *ports, priority=priority)
+
+    def read_many(self, port, addr, reg, length=1, priority=INTERACTIVE):
+        return self.call(lambda bus: bus.read_many(addr, reg, length), port,
+                         priority=priority)
+
+    def write_many(self, port, addr, reg, data, priority=INTERACTIVE):
+        self.call(lambda bus: bus.write_many(addr, reg, data), port,
+                  priority=priority)
+
+    def close(self, wait=True):
+        """Run the queued jobs, then stop the worker"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if wait:
+            self.thread.join()
+
+    def _next(self, priority=None):
+        # pop the next job, only if more urgent than `priority`
+        with self.cond:
+            if priority is None:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+            if not self.queue or (
+                    priority is not None and self.queue[0][0] >= priority):
+                return None
+            return heapq.heappop(self.queue)[2]
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            self._run(job)
+
+    def _run(self, job):
+        if not job.future.set_running_or_notify_cancel():
+            return
+        try:
+            self.bus.enable(*job.ports)
+            result = self._steps(job.fn(self.bus), job)
+        except Exception as e:
+            logger.debug("job %r failed", job.fn, exc_info=True)
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(result)
+
+    def _direct(self, fn, ports):
+        # nested call from a job, restore the switches of the job
+        paths = self.bus.mux.paths
+        try:
+            self.bus.enable(*ports)
+            return self._steps(fn(self.bus))
+        finally:
+            self.bus.mux.enable(*paths)
+
+    def _steps(self, result, job=None):
+        # run a generator result to the end, preempting at each step
+        if not inspect.isgenerator(result):
+            return result
+        while True:
+            try:
+                next(result)
+            except StopIteration as e:
+                return e.value
+            if job is not None:
+                self._preempt(job)
+
+    def _preempt(self, job):
+        # run more urgent jobs, restore the switches of the preempted one
+        paths = None
+        while True:
+            urgent = self._next(job.priority)
+            if urgent is None:
+                break
+            if paths is None:
+                paths = self.bus.mux.paths
+            self._run(urgent)
+        if paths is not None:
+            self.bus.mux.enable(*paths)
@@ -30,19 +30,16 @@ if __name__ == "__main__":
         try:
             bus.enable("LOC0")
             ee = EEPROM(bus)
+            old = ee.dump()
             try:
-                logger.info("valid data %s", Sinara.unpack(ee.dump()))
+                logger.info("valid data %s", Sinara.unpack(old))
             except:
                 logger.info("invalid data")  # , exc_info=True)
-            eui48 = ee.eui48()
-            print(ee.fmt_eui48())
+            eui48 = old[0xfa:]
+            print(ee.fmt_eui48(eui48))
             data = ee_data._replace(eui48=eui48)
-            ee.write(0, data.pack()[:128])
+            n = ee.update(0, data.pack()[:128])
             open("data/{}.bin".format(ee.fmt_eui48(eui48)), "wb").write(data.pack())
-            data = ee.dump()
-            try:
-                logger.info("data readback valid %s", Sinara.unpack(data))
-            except:
-                logger.error("data readback invalid %r", data, exc_info=True)
+            logger.info("%d bytes written and verified", n)
         finally:
             bus.enable()
@@ -0,0 +1,247 @@
+import logging
+from collections import namedtuple
+from contextlib import contextmanager, ExitStack
+
+from sinara import Sinara
+import chips
+
+logger = logging.getLogger(__name__)
+
+
+# SC18IS602B GPIO map on all boards: SS0 flash select, SS1 flash update
+# enable, SS2 CDONE, SS3 CRESET. GPIO values are written as given.
+Profile = namedtuple("Profile", (
+    "name",         # Sinara board name
+    "gpio_config",  # SS0-SS3 modes for `SPI.gpio_config()`
+    "init",         # GPIO value after init
+    "reset",        # GPIO value holding the FPGA in reset
+    "run",          # GPIO value releasing the reset
+    "upd",          # GPIO sequence entering flash update
+    "upd_exit",     # GPIO value leaving flash update
+    "power_down",   # power down the flash after update
+    "switch",       # (address, ports) of an on-board I2C switch or None
+    "sensors",      # LM75 addresses
+    "t_creload",    # expected configuration time
+    "timeout",      # configuration timeout
+))
+
+profiles = {
+    "banker": Profile(
+        "Banker", (0b00, 0b01, 0b10, 0b00), init=0b1000,
+        reset=0b0000, run=0b1000, upd=(0b0000, 0b1000, 0b0010),
+        upd_exit=0b1000, power_down=False, switch=(0x72, 0b101),
+        sensors=(0x48, 0x49), t_creload=.1, timeout=.3),
+    "fastino": Profile(
+        "Fastino", (0b00, 0b01, 0b10, 0b01), init=0b1000,
+        reset=0b0000, run=0b1000, upd=(0b0000, 0b1000, 0b0000, 0b0010),
+        upd_exit=0b1000, power_down=True, switch=None,
+        sensors=(0x48,), t_creload=.1, timeout=.5),
+    "phaser": Profile(
+        "Phaser", (0b00, 0b01, 0b10, 0b01), init=0b1000,
+        reset=0b1000, run=0b0000, upd=(0b1010,),
+        upd_exit=0b0001, power_down=False, switch=None,
+        sensors=(0x48, 0x49), t_creload=.1, timeout=1.),
+}
+
+
+class Board:
+    """FPGA EEM with EEPROM, LM75s, SC18IS602B SPI bridge and SPI flash"""
+    profile = None
+
+    def __init__(self, bus, profile=None):
+        if profile is not None:
+            self.profile = profile
+        self.bus = bus
+        self.sw = None
+        if self.profile.switch is not None:
+            self.sw = chips.PCA9548(bus, addr=self.profile.switch[0])
+        self.eeprom = chips.EEPROM(bus)
+        self.temp = [chips.LM75(bus, addr) for addr in self.profile.sensors]
+        self.spi = chips.SPI(bus, 0x2a)
+        self.flash = chips.SPIFlash(self.spi, 0b0001)
+
+    @contextmanager
+    def enabled(self):
+        """Connect the on-board devices (behind the board switch)"""
+        if self.sw is None:
+            yield self
+        else:
+            with self.sw.enabled(self.profile.switch[1]):
+                yield self
+
+    def init(self):
+        p = self.profile
+        self.spi.gpio_write(p.init)
+        self.spi.gpio_enable(0b1110)  # all but flash select
+        self.spi.gpio_config(*p.gpio_config)
+        # SPI disable, SS deassert, CRESET
+        self.spi.gpio_check(0b1011, 0b0001 | p.init & 0b1000)
+        # MSB-first, CPOL/CPHA=00, 1.8 MHz
+        self.spi.configure(order=0, mode=0, f=0)
+
+    def report(self):
+        ee = self.eeprom.dump()
+        try:
+            logger.info("Sinara eeprom valid %s", Sinara.unpack(ee))
+        except:
+            logger.error("eeprom data invalid %r", ee)
+        for temp in self.temp:
+            temp.report()
+        logger.info("gpio: %#02x", self.spi.gpio_read())
+
+    def report_flash(self):
+        logger.info("ident: %r", self.flash.read_identification())
+        logger.info("status: %#02x", self.flash.read_status())
+
+    def creload(self, timeout=None):
+        p = self.profile
+        self.spi.gpio_write_verify(p.reset, 0b1100)  # CRESET, not CDONE
+        self.spi.gpio_write_verify(p.run, 0b1000)  # CRESET deassert
+        t = self.spi.gpio_wait(0b0100, 0b0100,  # CDONE
+                               "{} creload".format(p.name.lower()),
+                               p.t_creload, timeout or p.timeout)
+        logger.info("creload took %g s", t)
+
+    @contextmanager
+    def flash_upd(self):
+        # freeze it while loading
+        for gpio in self.profile.upd:
+            self.spi.gpio_write(gpio)
+        try:
+            self.flash.wakeup()
+            yield
+            if self.profile.power_down:
+                self.flash.write_disable()
+                self.flash.power_down()
+        finally:
+            self.spi.gpio_write(self.profile.upd_exit)
+            self.spi.idle()
+
+    def dump(self, fil, length=None, offset=0):
+        length, digest = self.flash.dump(fil, offset, length)
+        logger.info("read %#x bytes, sha256 %s", length, digest)
+
+    def program(self, data, offset=0, verify=True, manifest=False):
+        """Program the flash
+
+        With `manifest`, the block hashes written or found on the flash are
+        kept in `data/{eui48}-flash.json` and blocks listed there are not
+        read before programming. Only use it if the flash is not written
+        otherwise.
+        """
+        return chips.drain(self.program_steps(data, offset, verify, manifest))
+
+    def program_steps(self, data, offset=0, verify=True, manifest=False):
+        """`program()` as a generator, see `SPIFlash.program_steps()`"""
+        if not manifest:
+            return (yield from self.flash.program_steps(
+                offset, data, verify=verify))
+        fil = "data/{}-flash.json".format(self.eeprom.fmt_eui48())
+        with chips.flash_manifest(fil) as m:
+            return (yield from self.flash.program_steps(
+                offset, data, m, verify=verify))
+
+    def eeprom_update(self, **kwargs):
+        eui48 = self.eeprom.eui48()
+        logger.info("eui48 %s", self.eeprom.fmt_eui48(eui48))
+        name = self.profile.name
+        ee_data = Sinara(
+            name=name,
+            board=Sinara.boards.index(name),
+            major=1, minor=0, variant=0, port=0,
+            vendor=Sinara.vendors.index("QUARTIQ"),
+            vendor_data=Sinara._defaults.vendor_data)
+        kwargs["eui48"] = eui48
+        data = ee_data._replace(**kwargs)
+        n = self.eeprom.update(0, data.pack()[:128])
+        open("data/{}.bin".format(self.eeprom.fmt_eui48(eui48)),
+             "wb").write(data.pack())
+        logger.info("%d bytes written and verified: %s", n, data)
+
+
+def run(bus, board, eems, eeprom=False, read=None, write=None,
+        reload=True, verify=True, manifest=False):
+    """Program several EEMs of one crate in one bus session
+
+    `read` is a file name format with the `eem` and `eui48` fields.
+    """
+    for eem in eems:
+        logger.info("%s: %s", eem, board)
+        with ExitStack() as stack:
+            stack.enter_context(bus.enabled(eem))
+            b = stack.enter_context(Board(bus, profiles[board]).enabled())
+            b.init()
+            b.report()
+            if eeprom:
+                b.eeprom_update()
+            if read or write:
+                with b.flash_upd():
+                    b.report_flash()
+                    if read:
+                        b.dump(read.format(
+                            eem=eem, eui48=b.eeprom.fmt_eui48()))
+                    if write:
+                        b.program(write, verify=verify, manifest=manifest)
+            if reload:
+                b.creload()
+
+
+def board_main(board, argv):
+    """`serial EEM eeprom|read|write [file]` of the per-board scripts"""
+    serial, eem, action = argv[:3]
+    args = ["-v", "-s", serial]
+    if action == "eeprom":
+        args.append("-e")
+    elif action == "read":
+        args.extend(["-r", argv[3]])
+    elif action == "write":
+        args.extend(["-w", argv[3]])
+    main(args + [board, eem])
+
+
+def main(argv=None):
+    import argparse
+    from kasli import Kasli
+
+    p = argparse.ArgumentParser()
+    p.add_argument("-s", "--serial", default="0")
+    p.add_argument("-p", "--port", default=2, type=int)
+    p.add_argument("-b", "--backend", default="auto",
+                   choices=["auto"] + sorted(Kasli.backends))
+    p.add_argument("-e", "--eeprom", action="store_true",
+                   help="update the Sinara EEPROM data")
+    p.add_argument("-r", "--read", help="dump the flash to this file, "
+                   "formatted with {eem} and {eui48}")
+    p.add_argument("-w", "--write", help="program the flash from this file")
+    p.add_argument("--no-verify", action="store_true")
+    p.add_argument("-m", "--manifest", action="store_true",
+                   help="trust and record the flash block hashes in "
+                   "data/{eui48}-flash.json")
+    p.add_argument("-n", "--no-reload", action="store_true",
+                   help="don't reconfigure the FPGA")
+    p.add_argument("-v", "--verbose", default=0, action="count")
+    p.add_argument("board", choices=sorted(profiles))
+    p.add_argument("eem", nargs="+", help="EEM ports, e.g. EEM4")
+    args = p.parse_args(argv)
+
+    logging.basicConfig(
+        level=[logging.WARNING, logging.INFO, logging.DEBUG][args.verbose])
+
+    write = None
+    if args.write:
+        with open(args.write, "rb") as fil:
+            write = fil.read()
+    url = "ftdi://ftdi:4232h:{}/{}".format(args.serial, args.port)
+    if args.backend == "sim":
+        url = "sim"
+    with Kasli(args.backend).configure(url) as bus:
+        bus.reset()
+        try:
+            run(bus, args.board, args.eem, args.eeprom, args.read, write,
+                not args.no_reload, not args.no_verify, args.manifest)
+        finally:
+            bus.enable()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import time
 import logging
+from array import array
+from collections import Counter, namedtuple
 from contextlib import contextmanager
 
 from pyftdi.ftdi import Ftdi
@@ -15,44 +17,101 @@ except:  # pyftdi >= 0.49.0
     BITMODE_BITBANG = Ftdi.BitMode.BITBANG
 
 
+# EN and RESET pins, RESET polarity
+Wiring = namedtuple("Wiring", "en reset reset_active_high")
+WIRINGS = {
+    "v1": Wiring(1 << 4, 1 << 5, False),  # <v2.0
+    "v2.0": Wiring(1 << 4, 1 << 5, True),
+    "v2": Wiring(1 << 6, 1 << 5, True),  # >v2.0
+}
+
+
 class I2C:
     SCL = 1 << 0
     SDAO = 1 << 1
     SDAI = 1 << 2
     EN = (1 << 4) | (1 << 6)  # 4 on <=v2.0, 6 on >v2.0
     RESET = 1 << 5  # active high on >=v2.0, active low on <v2.0
+    reset_active_high = True
     max_clock_stretch = 100
 
-    def __init__(self):
+    def __init__(self, wiring=None):
+        if wiring is not None:
+            self.EN, self.RESET, self.reset_active_high = wiring
         self.dev = Ftdi()
         self._time = 0
+        # shadow registers: requested direction, direction and output on
+        # the bus, number of updates folded into the pending direction
         self._direction = 0
+        self._bus_direction = 0
+        self._output = 0
+        self._merged = 0
+        self.usb = Counter()  # issued and elided USB operations
 
     def configure(self, url, **kwargs):
         self.dev.open_bitbang_from_url(url, **kwargs)
+        self._bus_direction = self._direction = kwargs.get("direction", 0)
         return self
 
+    def close(self):
+        self.dev.close()
+
     def tick(self):
         self._time += 1
 
+    def enabled_output(self):
+        """Output value with EN asserted and RESET deasserted"""
+        return self.EN | (0 if self.reset_active_high else self.RESET)
+
     def reset(self):
-        self.write(self.EN | self.RESET)
+        on = self.enabled_output()
+        self.write(on ^ self.RESET)
         self.tick()
-        self.write(self.EN)
+        self.write(on)
         self.tick()
         time.sleep(.01)
 
     def set_direction(self, direction):
         self._direction = direction
+        self._merged += 1
+        self.flush()
+
+    def flush(self):
+        """Issue the pending direction update unless it is a no-op"""
+        n, self._merged = self._merged, 0
+        if self._direction != self._bus_direction:
+            self._bus_direction = self._direction
+            self._set_direction(self._direction)
+            self.usb["issued"] += 1
+            n -= 1
+        self.usb["elided"] += max(n, 0)
+
+    def _set_direction(self, direction):
         self.dev.set_bitmode(direction, BITMODE_BITBANG)
 
     def write(self, data):
+        self.flush()
+        if data == self._output:
+            self.usb["elided"] += 1
+            return
+        self._output = data
+        self._write(data)
+        self.usb["issued"] += 1
+
+    def _write(self, data):
         self.dev.write_data(bytes([data]))
 
     def read(self):
+        self.flush()
+        self.usb["issued"] += 1
+        return self._read()
+
+    def _read(self):
         return self.dev.read_pins()
 
     def scl_oe(self, oe):
+        # never merge an SDA change into an SCL edge
+        self.flush()
         d = self._direction & ~self.SCL
         if oe:
             d |= self.SCL
@@ -62,7 +121,12 @@ class I2C:
         d = self._direction & ~self.SDAO
         if oe:
             d |= self.SDAO
-        self.set_direction(d)
+        self._direction = d
+        self._merged += 1
+        # while SCL is held low only the last SDA value matters, defer it
+        # to the next SCL edge or pin read
+        if not self._bus_direction & self._direction & self.SCL:
+            self.flush()
 
     def scl_i(self):
         return bool(self.read() & self.SCL)
@@ -79,7 +143,7 @@ class I2C:
 
     def acquire(self):
         # EN, !SCL, !SDA
-        self.write(self.EN)
+        self.write(self.enabled_output())
         # enable USB-I2C
         self.set_direction(self.EN | self.RESET)
         self.tick()
@@ -162,6 +226,7 @@ class I2C:
         self.start()
 
     def write_data(self, data):
+        self.usb["bytes"] += 1
         for i in range(8):
             bit = bool(data & (1 << 7 - i))
             self.sda_oe(not bit)
@@ -184,6 +249,7 @@ class I2C:
         return ack
 
     def read_data(self, ack=True):
+        self.usb["bytes"] += 1
         self.sda_oe(False)
         data = 0
         for i in range(8):
@@ -208,6 +274,7 @@ class I2C:
 
     @contextmanager
     def xfer(self):
+        self.usb["transactions"] += 1
         self.start()
         try:
             yield
@@ -259,3 +326,244 @@ class I2C:
     def poll(self, addr, write=False):
         with self.xfer():
             return self.write_data((addr << 1) | int(not write))
+
+
+class Waveform:
+    """Compiled MPSSE pin waveform of one or more I2C transactions
+
+    Every step sets output values and direction of the low byte (SCL/SDA are
+    open-drain: pulled low by enabling the output, released by disabling it)
+    and is repeated `hold` times. Samples are taken where the bitbang
+    driver would read the pins and are decoded after the waveform has run.
+    Every sample reads the pins `stretch` times in a row, the first with
+    SCL high is used.
+
+    Step and sample durations are those of MPSSE command execution, not a
+    set SCL frequency, and the stretch window is only about a microsecond:
+    slow SCL rise is tolerated, clock stretching by slaves is not.
+    """
+    def __init__(self, output, direction, hold=4, max_samples=1024,
+                 stretch=4):
+        self.output = output
+        self.direction = direction
+        self.hold = hold
+        self.max_samples = max_samples
+        self.stretch = stretch
+        self.chunks = [array("B")]
+        self.counts = [0]
+        self.samples = []
+        self.transactions = 0
+        self.bytes = 0
+
+    def set(self, pin, oe):
+        d = self.direction & ~pin
+        if oe:
+            d |= pin
+        self.direction = d
+        self.chunks[-1].extend(
+            (Ftdi.SET_BITS_LOW, self.output, d) * self.hold)
+
+    def sample(self, kind, arg=None):
+        if self.counts[-1] + self.stretch > self.max_samples:
+            # don't overrun the device RX FIFO, read back in between
+            self.chunks.append(array("B"))
+            self.counts.append(0)
+        self.chunks[-1].extend([Ftdi.GET_BITS_LOW]*self.stretch)
+        self.counts[-1] += self.stretch
+        self.samples.append((kind, arg))
+
+    def start(self):
+        self.transactions += 1
+        self.sample("start")
+        self.set(I2C.SDAO, True)
+        self.set(I2C.SCL, True)
+
+    def stop(self):
+        self.set(I2C.SCL, False)
+        self.sample("scl")
+        self.set(I2C.SDAO, False)
+        self.sample("stop")
+
+    def restart(self):
+        self.set(I2C.SDAO, False)
+        self.set(I2C.SCL, False)
+        self.sample("scl")
+        self.transactions -= 1
+        self.start()
+
+    def write(self, data, nack=None):
+        """Write a byte, raise `nack` if not acknowledged"""
+        self.bytes += 1
+        for i in range(8):
+            bit = bool(data & (1 << 7 - i))
+            self.set(I2C.SDAO, not bit)
+            self.set(I2C.SCL, False)
+            self.sample("bit", bit)
+            self.set(I2C.SCL, True)
+        self.set(I2C.SDAO, False)
+        self.set(I2C.SCL, False)
+        self.sample("ack", nack)
+        self.set(I2C.SCL, True)
+        self.set(I2C.SDAO, True)
+
+    def read(self, ack=True):
+        self.bytes += 1
+        self.set(I2C.SDAO, False)
+        for i in range(8):
+            self.set(I2C.SCL, False)
+            self.sample("data")
+            self.set(I2C.SCL, True)
+        self.set(I2C.SDAO, ack)
+        self.set(I2C.SCL, False)
+        self.sample("ackout", ack)
+        self.set(I2C.SCL, True)
+        self.set(I2C.SDAO, True)
+
+    def decode(self, pins):
+        """Check the sampled pins, return ACKs and read data"""
+        acks = []
+        data = bytearray()
+        byte = 0
+        for i, (kind, arg) in enumerate(self.samples):
+            window = pins[i*self.stretch:(i + 1)*self.stretch]
+            p = next((p for p in window if p & I2C.SCL), None)
+            if p is None:
+                raise ValueError("SCL low exceeded clock stretch limit")
+            sda = bool(p & I2C.SDAI)
+            if kind in ("start", "stop"):
+                if not sda:
+                    raise ValueError("Arbitration lost")
+            elif kind == "bit":
+                if sda != arg:
+                    raise ValueError("Arbitration lost")
+            elif kind == "ack":
+                acks.append(not sda)
+                if sda and arg is not None:
+                    raise arg
+            elif kind == "data":
+                byte = (byte << 1) | sda
+            elif kind == "ackout":
+                if sda == arg:
+                    raise ValueError("Arbitration lost")
+                data.append(byte)
+                byte = 0
+        return acks, bytes(data)
+
+
+class I2CSync(I2C):
+    """Batched MPSSE waveform I2C
+
+    Each transaction is compiled into one pin waveform, pushed with a single
+    USB write and decoded from the pin samples read back in one go.
+
+    FTDI synchronous bitbang mode can not change pin directions within a
+    write and SCL/SDA are driven open-drain through the direction register,
+    so it can not drive this bus. The waveform is issued as MPSSE
+    SET_BITS_LOW/GET_BITS_LOW commands instead, which carry value and
+    direction for every step. This needs an MPSSE interface (FT4232H ports
+    1 and 2): on ports 3 and 4 (Kasli v1.0) only the `I2C` bitbang driver
+    works. Slaves stretching SCL beyond the `Waveform` sample window are
+    not supported, use `I2C` for those.
+    """
+    hold = 4  # MPSSE commands per waveform step
+    max_samples = 1024  # half the FT4232H RX FIFO
+    stretch = 4  # pin reads per sample, see `Waveform`
+
+    def configure(self, url, **kwargs):
+        self.dev.open_mpsse_from_url(url, **kwargs)
+        self._bus_direction = self._direction = kwargs.get("direction", 0)
+        return self
+
+    def _set_direction(self, direction):
+        self.dev.write_data(bytes([
+            Ftdi.SET_BITS_LOW, self._output, direction]))
+
+    def _write(self, data):
+        self.dev.write_data(bytes([
+            Ftdi.SET_BITS_LOW, data, self._bus_direction]))
+
+    def _read(self):
+        self.dev.write_data(bytes([Ftdi.GET_BITS_LOW, Ftdi.SEND_IMMEDIATE]))
+        return self._read_bytes(1)[0]
+
+    def _read_bytes(self, length):
+        data = bytearray()
+        while len(data) < length:
+            r = self.dev.read_data_bytes(length - len(data), 4)
+            if not r:
+                raise ValueError("no answer from FTDI")
+            data.extend(r)
+        return data
+
+    def waveform(self):
+        self.flush()
+        return Waveform(self._output, self._direction, self.hold,
+                        self.max_samples, self.stretch)
+
+    def run(self, w):
+        """Issue the waveform, return the decoded ACKs and read data"""
+        pins = bytearray()
+        for chunk, n in zip(w.chunks, w.counts):
+            self.dev.write_data(chunk + array("B", [Ftdi.SEND_IMMEDIATE]))
+            pins.extend(self._read_bytes(n))
+            self.usb["issued"] += 1
+        self._direction = self._bus_direction = w.direction
+        self._time += len(w.samples)
+        self.usb["transactions"] += w.transactions
+        self.usb["bytes"] += w.bytes
+        return w.decode(pins)
+
+    def write_single(self, addr, data, ack=True):
+        w = self.waveform()
+        w.start()
+        w.write(addr << 1, I2CNACK("Address Write NACK", addr))
+        w.write(data, I2CNACK("Data NACK", addr, data) if ack else None)
+        w.stop()
+        self.run(w)
+
+    def read_single(self, addr):
+        w = self.waveform()
+        w.start()
+        w.write((addr << 1) | 1, I2CNACK("Address Read NACK", addr))
+        w.read(ack=False)
+        w.stop()
+        return self.run(w)[1][0]
+
+    def write_many(self, addr, reg, data, ack=True):
+        w = self.waveform()
+        w.start()
+        w.write(addr << 1, I2CNACK("Address Write NACK", addr))
+        w.write(reg, I2CNACK("Reg NACK", reg))
+        for i, byte in enumerate(data):
+            w.write(byte, I2CNACK("Data NACK", data)
+                    if ack or i < len(data) - 1 else None)
+        w.stop()
+        self.run(w)
+
+    def read_many(self, addr, reg, length=1):
+        w = self.waveform()
+        w.start()
+        w.write(addr << 1, I2CNACK("Address Write NACK", addr))
+        w.write(reg, I2CNACK("Reg NACK", reg))
+        w.restart()
+        w.write((addr << 1) | 1, I2CNACK("Address Read NACK", addr))
+        for i in range(length):
+            w.read(ack=i < length - 1)
+        w.stop()
+        return self.run(w)[1]
+
+    def read_stream(self, addr, length=1):
+        w = self.waveform()
+        w.start()
+        w.write((addr << 1) | 1, I2CNACK("Address Read NACK", addr))
+        for i in range(length):
+            w.read(ack=i < length - 1)
+        w.stop()
+        return self.run(w)[1]
+
+    def poll(self, addr, write=False):
+        w = self.waveform()
+        w.start()
+        w.write((addr << 1) | int(not write))
+        w.stop()
+        return self.run(w)[0][0]
@@ -1,5 +1,6 @@
 import logging
 from array import array
+from collections import Counter, namedtuple
 
 from pyftdi.ftdi import Ftdi
 from pyftdi.i2c import I2cController
@@ -7,51 +8,194 @@ from pyftdi.i2c import I2cController
 logger = logging.getLogger(__name__)
 
 
+# ACK of address and each written byte, read data
+Result = namedtuple("Result", "acks data")
+
+
+class Batch:
+    """Queue of I2C transactions issued as one MPSSE command buffer
+
+    Transactions are queued with the bus methods (`write_single()`,
+    `read_many()`, `poll()`, ...) and issued by `execute()` (or on leaving
+    the context) with one write and one read-back per `max_reply` bytes of
+    reply. Transactions are not aborted on NACK: they run to their STOP and
+    `execute()` returns a `Result` per transaction in queue order.
+    """
+    max_reply = 1024  # half the FT4232H RX FIFO
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.chunks = [(array("B"), [])]
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    # command sequences as in pyftdi's I2cController, without the
+    # open-drain outputs of the FT232H SDA is made an input to read
+
+    def _write(self, cmd, data):
+        b = self.bus
+        for byte in data:
+            if b._fake_tristate:
+                # SCL low, SDA output again
+                cmd.extend(b._clk_lo_data_hi)
+            cmd.extend(b._write_byte)
+            cmd.append(byte & 0xff)
+            # SCL low, SDA high-Z, read ACK
+            if b._fake_tristate:
+                cmd.extend(b._clk_lo_data_input)
+            else:
+                cmd.extend(b._clk_lo_data_hi)
+            cmd.extend(b._read_bit)
+
+    def _read(self, cmd, length):
+        b = self.bus
+        for i in range(length):
+            last = i == length - 1
+            if b._fake_tristate:
+                cmd.extend(b._clk_lo_data_input)
+                cmd.extend(b._read_byte)
+                cmd.extend(b._clk_lo_data_hi)
+            else:
+                cmd.extend(b._read_byte)
+            cmd.extend(b._nack if last else b._ack)
+            # keep SDA low after an ACK, the slave drives the next byte
+            cmd.extend((b._clk_lo_data_hi if last or not b._fake_tristate
+                        else b._clk_lo_data_lo) * b._ck_delay)
+
+    def _start(self, cmd, addr):
+        b = self.bus
+        cmd.extend(b._idle * b._ck_delay)
+        cmd.extend(b._start)
+        self._write(cmd, [addr])
+
+    def _stop(self, cmd):
+        b = self.bus
+        cmd.extend(b._stop)
+        if b._fake_tristate:
+            # SCL high-Z, SDA high-Z
+            cmd.extend(b._clk_input_data_input)
+
+    def queue(self, addr, out=b"", readlen=None):
+        """Queue a transaction, return its index
+
+        Writes `out`, then with `readlen` not None reads `readlen` bytes
+        (after a repeated start if `out` is not empty).
+        """
+        cmd = array("B")
+        acks = 0
+        if out or readlen is None:
+            self._start(cmd, addr << 1)
+            self._write(cmd, out)
+            acks += 1 + len(out)
+        if readlen is not None:
+            self._start(cmd, (addr << 1) | 1)
+            self._read(cmd, readlen)
+            acks += 1
+        self._stop(cmd)
+        chunk, layout = self.chunks[-1]
+        reply = sum(a + r for a, r in layout)
+        if layout and reply + acks + (readlen or 0) > self.max_reply:
+            chunk, layout = array("B"), []
+            self.chunks.append((chunk, layout))
+        chunk.extend(cmd)
+        layout.append((acks, readlen or 0))
+        self.bus.usb["transactions"] += 1
+        self.bus.usb["bytes"] += 1 + len(out) + bool(out and readlen) + (
+            readlen or 0)
+        return sum(len(layout) for chunk, layout in self.chunks) - 1
+
+    def write_single(self, addr, data):
+        return self.queue(addr, bytes([data]))
+
+    def read_single(self, addr):
+        return self.queue(addr, readlen=1)
+
+    def write_many(self, addr, reg, data):
+        return self.queue(addr, bytes([reg]) + bytes(data))
+
+    def read_many(self, addr, reg, length=1):
+        return self.queue(addr, bytes([reg]), length)
+
+    def read_stream(self, addr, length=1):
+        return self.queue(addr, readlen=length)
+
+    def poll(self, addr, write=False):
+        if write:
+            return self.queue(addr)
+        return self.queue(addr, readlen=0)
+
+    def execute(self):
+        b = self.bus
+        self.results = []
+        for cmd, layout in self.chunks:
+            if not layout:
+                continue
+            cmd.append(Ftdi.SEND_IMMEDIATE)
+            b._ftdi.write_data(cmd)
+            n = sum(a + r for a, r in layout)
+            reply = bytearray()
+            while len(reply) < n:
+                r = b._ftdi.read_data_bytes(n - len(reply), 4)
+                if not r:
+                    raise ValueError("no answer from FTDI")
+                reply.extend(r)
+            b.usb["issued"] += 1
+            i = 0
+            for acks, readlen in layout:
+                ack = [not reply[i + j] & b.BIT0 for j in range(acks)]
+                i += acks
+                # the read address ACK precedes the data
+                self.results.append(Result(ack, bytes(reply[i:i + readlen])))
+                i += readlen
+        self.chunks = [(array("B"), [])]
+        return self.results
+
+
 class I2C(I2cController):
     EN = 1 << 4
     RESET_B = 1 << 5
+    reset_active_high = False
 
-    def __init__(self):
+    def __init__(self, wiring=None):
         super().__init__()
+        if wiring is not None:
+            self.EN, self.RESET_B, self.reset_active_high = wiring
+        self.usb = Counter()
         self.log.setLevel(logging.ERROR)  # suppress NACK warnings on poll()
-        self._direction |= self.EN | self.RESET_B
-        self._idle = (Ftdi.SET_BITS_LOW, self.IDLE, self._direction)
-        self._data_lo = (Ftdi.SET_BITS_LOW,
-                         self.IDLE & ~self.SDA_O_BIT, self._direction)
-        self._clk_lo_data_lo = (Ftdi.SET_BITS_LOW,
-                                self.IDLE & ~(self.SDA_O_BIT | self.SCL_BIT),
-                                self._direction)
-        self._clk_lo_data_hi = (Ftdi.SET_BITS_LOW,
-                                self.IDLE & ~self.SCL_BIT,
-                                self._direction)
+
+    def enabled_output(self):
+        """EN and RESET levels with EN asserted and RESET deasserted"""
+        return self.EN | (0 if self.reset_active_high else self.RESET_B)
 
     def configure(self, url, **kwargs):
         super().configure(url, **kwargs)
-        if self._tristate:
-            self._tristate = (Ftdi.SET_BITS_LOW, self.EN | self.RESET_B,
-                              self.SCL_BIT | self.EN | self.RESET_B)
+        # EN and RESET are GPIOs, pyftdi drives them with every I2C command
+        pins = self.EN | self.RESET_B
+        self.set_gpio_direction(pins, pins)
+        self.write_gpio(self.enabled_output())
         # self.set_retry_count(1)
         return self
 
     def reset_switch(self):
-        cmd = array("B")
-        cmd.extend((Ftdi.SET_BITS_LOW, self.IDLE & ~self.RESET_B,
-                    self._direction) * 100)
-        cmd.extend((Ftdi.SET_BITS_LOW, self.IDLE,
-                    self._direction) * 100)
-        self._ftdi.write_data(cmd)
+        on = self.enabled_output()
+        self.write_gpio(on ^ self.RESET_B)
+        self.write_gpio(on)
+
+    def reset(self):
+        self.reset_switch()
 
     def acquire(self):
-        cmd = array("B")
-        cmd.extend((Ftdi.SET_BITS_LOW, self.IDLE, self._direction))
-        self._ftdi.write_data(cmd)
+        self.write_gpio(self.enabled_output())
 
     def release(self):
-        cmd = array("B")
-        cmd.extend((Ftdi.SET_BITS_LOW, self.IDLE & ~self.EN,
-                    self._direction))
-        self._ftdi.write_data(cmd)
-        self.terminate()
+        self.write_gpio(self.enabled_output() & ~self.EN)
+        self.close()
 
     def __enter__(self):
         self.acquire()
@@ -60,18 +204,36 @@ class I2C(I2cController):
     def __exit__(self, exc_type, exc_value, traceback):
         self.release()
 
+    def batch(self):
+        return Batch(self)
+
+    def _count(self, written, read):
+        # pyftdi reads back the ACK of every written byte
+        self.usb["transactions"] += 1
+        self.usb["bytes"] += written + read
+        self.usb["issued"] += written + bool(read)
+
     def write_single(self, addr, data):
+        self._count(2, 0)
         self.write(addr, bytes([data]), relax=True)
 
     def read_single(self, addr):
-        return self.read(addr, readlen=1, relax=True)
+        self._count(1, 1)
+        return self.read(addr, readlen=1, relax=True)[0]
 
     def write_many(self, addr, reg, data):
+        self._count(2 + len(data), 0)
         self.write(addr, bytes([reg]) + bytes(data), relax=True)
 
     def read_many(self, addr, reg, length=1):
+        self._count(3, length)
         return bytes(self.exchange(addr, bytes([reg]), readlen=length,
                                    relax=True))
 
     def read_stream(self, addr, length=1):
+        self._count(1, length)
         return bytes(self.read(addr, readlen=length, relax=True))
+
+    def poll(self, addr, write=False):
+        self._count(1, 0)
+        return super().poll(addr, write=write)
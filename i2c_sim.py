@@ -0,0 +1,822 @@
+import time
+import logging
+import struct
+from collections import Counter
+
+from pyftdi.i2c import I2cNackError
+
+logger = logging.getLogger(__name__)
+
+I2CNACK = I2cNackError
+
+
+class Device:
+    """Transaction level model of an I2C slave"""
+    def clock(self):
+        return time.monotonic()
+
+    def start(self, read):
+        """Address phase, return ACK"""
+        return True
+
+    def write(self, data):
+        """Data byte from master, return ACK"""
+        return True
+
+    def read(self):
+        return 0xff
+
+    def stop(self):
+        pass
+
+
+class Memory(Device):
+    """Byte addressed memory with auto-incrementing pointer"""
+    def __init__(self, data=b"", size=256):
+        self.mem = bytearray(data) + bytearray(b"\xff"*(size - len(data)))
+        self.ptr = 0
+        self._first = False
+
+    def start(self, read):
+        self._first = not read
+        return True
+
+    def write(self, data):
+        if self._first:
+            self.ptr = data
+            self._first = False
+            return True
+        self.store(self.ptr, data)
+        self.ptr = (self.ptr + 1) % len(self.mem)
+        return True
+
+    def store(self, addr, data):
+        self.mem[addr] = data
+
+    def read(self):
+        data = self.mem[self.ptr]
+        self.ptr = (self.ptr + 1) % len(self.mem)
+        return data
+
+
+class EEPROM(Memory):
+    """24C02 with read-only upper half and EUI-48 (24AA02E48)"""
+    def __init__(self, eui48=b"\x80\x1f\x12\x00\x00\x00", data=b"",
+                 pagesize=8, t_wr=5e-3):
+        super().__init__(data)
+        self.mem[0xfa:] = eui48
+        self.pagesize = pagesize
+        self.t_wr = t_wr
+        self._busy = 0
+        self._page = None
+
+    def start(self, read):
+        if self.clock() < self._busy:
+            return False
+        self._page = {}
+        return super().start(read)
+
+    def store(self, addr, data):
+        self._page[addr] = data
+
+    def write(self, data):
+        if self._first:
+            return super().write(data)
+        page = self.ptr & ~(self.pagesize - 1)
+        self.store(self.ptr, data)
+        self.ptr = page | ((self.ptr + 1) & (self.pagesize - 1))
+        return True
+
+    def stop(self):
+        if self._page:
+            for addr, data in self._page.items():
+                if addr < 0x80:
+                    self.mem[addr] = data
+            self._busy = self.clock() + self.t_wr
+        self._page = None
+
+
+class LM75(Device):
+    """Temperature sensor, pointer register and 1/2 byte registers"""
+    def __init__(self, temperature=25.):
+        self.regs = [self.temp_to_mu(temperature), [0],
+                     self.temp_to_mu(75.), self.temp_to_mu(80.)]
+        self.ptr = 0
+        self._n = None
+
+    @staticmethod
+    def temp_to_mu(t):
+        return list(struct.pack(">h", int(t*(1 << 8)) & ~0x7f))
+
+    def start(self, read):
+        self._n = 0 if read else None
+        return True
+
+    def write(self, data):
+        if self._n is None:
+            self.ptr = data & 3
+            self._n = 0
+        elif self.ptr:
+            reg = self.regs[self.ptr]
+            if self._n < len(reg):
+                reg[self._n] = data
+            self._n += 1
+        return True
+
+    def read(self):
+        reg = self.regs[self.ptr]
+        data = reg[self._n % len(reg)]
+        self._n += 1
+        return data
+
+
+class PCF8574(Device):
+    """Quasi-bidirectional 8 bit port"""
+    def __init__(self, inputs=0xff):
+        self.inputs = inputs
+        self.output = 0xff
+
+    def write(self, data):
+        self.output = data
+        return True
+
+    def read(self):
+        return self.output & self.inputs
+
+
+class PCA9548(Device):
+    """8 port I2C switch, `ports` are the address maps behind each port"""
+    def __init__(self, ports=None):
+        self.ports = ports or [{} for _ in range(8)]
+        self.enabled = 0
+
+    def write(self, data):
+        self.enabled = data
+        return True
+
+    def read(self):
+        return self.enabled
+
+
+class Si5324(Memory):
+    """Register map with ident, LOS/LOL status and calibration lock"""
+    def __init__(self, xtal=True, clkin1=True, clkin2=True, t_lock=.1):
+        super().__init__(size=256)
+        self.mem[134:136] = b"\x01\x82"
+        self.xtal = xtal
+        self.clkin1 = clkin1
+        self.clkin2 = clkin2
+        self.t_lock = t_lock
+        self._locked = None
+
+    def store(self, addr, data):
+        if addr == 136 and data & 0x40:  # ICAL
+            self._locked = self.clock() + self.t_lock
+            data &= ~0x40
+        self.mem[addr] = data
+
+    def read(self):
+        los = ((not self.xtal) | (not self.clkin1) << 1 |
+               (not self.clkin2) << 2)
+        self.mem[129] = los
+        self.mem[130] = int(self._locked is None or
+                            self.clock() < self._locked)
+        return super().read()
+
+
+class SFF8472(Memory):
+    """SFP module A0h page with valid CC_BASE, the A2h page is `diag`"""
+    def __init__(self, vendor=b"QUARTIQ", part=b"SIM-SFP",
+                 serial=b"0000", temperature=30., vcc=3.3):
+        super().__init__()
+        self.mem[:96] = bytes(96)
+        self.mem[0] = 0x03  # SFP
+        self.mem[20:36] = vendor.ljust(16)
+        self.mem[40:56] = part.ljust(16)
+        self.mem[68:84] = serial.ljust(16)
+        self.mem[92] = 0x68  # DDM, internally calibrated, average power
+        self.mem[63] = sum(self.mem[:63]) & 0xff
+        self.mem[95] = sum(self.mem[64:95]) & 0xff
+        self.diag = Memory(bytes(256))
+        self.diag.mem[96:106] = struct.pack(
+            ">hHHHH", int(temperature*256), int(vcc/100e-6), 3000, 3000,
+            3000)
+
+    def store(self, addr, data):
+        pass
+
+
+class SPIFlash:
+    """SPI NOR flash model, JEDEC ID, status, program/erase timing"""
+    def __init__(self, jedec=b"\xef\x40\x16", size=4 << 20, t_page=.7e-3,
+                 t_erase={0x20: 45e-3, 0x52: 120e-3, 0xd8: 150e-3}):
+        self.jedec = jedec
+        self.mem = bytearray(b"\xff"*size)
+        self.t_page = t_page
+        self.t_erase = t_erase
+        self.wel = False
+        self._busy = 0
+
+    def clock(self):
+        return time.monotonic()
+
+    def xfer(self, data):
+        data = bytes(data)
+        cmd = data[0]
+        busy = self.clock() < self._busy
+        if cmd == 0x05:
+            return bytes([0, busy | (self.wel << 1)] + [0]*(len(data) - 2))
+        if busy:
+            return b"\xff"*len(data)
+        if cmd == 0x9f:
+            return (b"\xff" + self.jedec).ljust(len(data), b"\xff")[
+                :len(data)]
+        if cmd == 0x06:
+            self.wel = True
+        elif cmd == 0x04:
+            self.wel = False
+        elif cmd in (0x03, 0x0b):
+            dummy = 5 if cmd == 0x0b else 4
+            addr = int.from_bytes(data[1:4], "big")
+            n = len(data) - dummy
+            return b"\xff"*dummy + bytes(
+                self.mem[(addr + i) % len(self.mem)] for i in range(n))
+        elif cmd == 0x02 and self.wel:
+            addr = int.from_bytes(data[1:4], "big")
+            page = addr & ~0xff
+            for i, b in enumerate(data[4:]):
+                a = page | ((addr + i) & 0xff)
+                self.mem[a] &= b
+            self.wel = False
+            self._busy = self.clock() + self.t_page
+        elif cmd in self.t_erase and self.wel:
+            size = {0x20: 4 << 10, 0x52: 32 << 10, 0xd8: 64 << 10}[cmd]
+            addr = int.from_bytes(data[1:4], "big") & ~(size - 1)
+            self.mem[addr:addr + size] = b"\xff"*size
+            self.wel = False
+            self._busy = self.clock() + self.t_erase[cmd]
+        return b"\xff"*len(data)
+
+
+class SC18IS602B(Device):
+    """I2C to SPI bridge with GPIO and an FPGA CRESET/CDONE model
+
+    `creset` is the GPIO bit driving the FPGA configuration reset
+    (deasserted when high unless `creset_active_high`), `cdone` the input
+    bit reporting configuration done `t_load` after CRESET deassertion.
+    """
+    def __init__(self, spi=None, creset=0b1000, cdone=0b0100,
+                 creset_active_high=False, t_load=20e-3, f_spi=1.8e6):
+        self.spi = spi or {}  # slave select mask: SPI device
+        self.creset = creset
+        self.cdone = cdone
+        self.creset_active_high = creset_active_high
+        self.t_load = t_load
+        self.f_spi = f_spi
+        self.buffer = bytes(200)
+        self.gpio_out = 0xff
+        self.gpio_en = 0
+        self.gpio_cfg = 0
+        self._cmd = None
+        self._data = []
+        self._write = False
+        self._ptr = 0
+        self._busy = 0
+        self._done = 0
+
+    def clock(self):
+        return time.monotonic()
+
+    def attach(self, clock):
+        self.clock = clock
+        for dev in self.spi.values():
+            dev.clock = clock
+
+    def start(self, read):
+        if self.clock() < self._busy:
+            return False  # busy with the SPI transfer
+        self._write = not read
+        if not read:
+            self._cmd = None
+            self._data = []
+        self._ptr = 0
+        return True
+
+    def write(self, data):
+        if self._cmd is None:
+            self._cmd = data
+        else:
+            self._data.append(data)
+        return True
+
+    def read(self):
+        data = self.buffer[self._ptr % len(self.buffer)]
+        self._ptr += 1
+        return data
+
+    def stop(self):
+        if not self._write or self._cmd is None:
+            return
+        cmd, data = self._cmd, self._data
+        self._write = False
+        if cmd < 0x10 and data:
+            dev = self.spi.get(cmd)
+            self.buffer = dev.xfer(data) if dev else b"\xff"*len(data)
+            self._busy = self.clock() + len(data)*8/self.f_spi
+        elif cmd == 0xf4 and data:
+            was = bool(self.gpio_out & self.creset) == self.creset_active_high
+            self.gpio_out = data[0]
+            if bool(data[0] & self.creset) == self.creset_active_high:
+                self._done = None
+            elif was:
+                self._done = self.clock() + self.t_load
+        elif cmd == 0xf5:
+            done = self._done is not None and self.clock() >= self._done
+            # slave selects not used as GPIO idle high
+            pins = self.gpio_out & self.gpio_en | ~self.gpio_en
+            pins = pins & ~self.cdone | (self.cdone if done else 0)
+            self.buffer = bytes([pins & 0x0f])
+        elif cmd == 0xf6 and data:
+            self.gpio_en = data[0]
+        elif cmd == 0xf7 and data:
+            self.gpio_cfg = data[0]
+
+
+class Latency:
+    """USB cost model of a driver
+
+    A transaction writing `w` and reading `r` bytes costs
+    `transaction + write*w + read*r` USB round-trips of `latency` seconds
+    each plus the wire time of its bits at `frequency`.
+    """
+    profiles = {
+        # per transaction, per written byte, per read byte
+        "bitbang": (12, 33, 28),
+        "sync": (1, 1/113, 1/113),
+        "mpsse": (2, 1, 0),
+        "ideal": (0, 0, 0),
+    }
+
+    def __init__(self, profile="bitbang", latency=125e-6, frequency=100e3):
+        self.transaction, self.write, self.read = self.profiles[profile]
+        self.latency = latency
+        self.frequency = frequency
+
+    def cost(self, written, read):
+        round_trips = (self.transaction + self.write*written +
+                       self.read*read)
+        wire = (9*(written + read) + 3)/self.frequency
+        return round_trips, round_trips*self.latency + wire
+
+
+class I2C:
+    """Simulated I2C bus
+
+    `root` maps addresses to `Device` models, `PCA9548` switches carry
+    address maps behind their ports. The cost of every transaction is taken
+    from `latency` and either slept (`sleep=True`, wall time like on
+    hardware) or added to the simulated clock.
+    """
+    def __init__(self, root=None, latency=None, sleep=False):
+        if root is None:
+            root = kasli_tree()
+        self.root = root
+        self.latency = latency or Latency()
+        self.sleep = sleep
+        self._skew = 0.
+        self.usb = Counter()
+        self.attach(root)
+
+    def configure(self, url=None, **kwargs):
+        return self
+
+    def close(self):
+        pass
+
+    def time(self):
+        return time.monotonic() + self._skew
+
+    def attach(self, scope):
+        for dev in scope.values():
+            if hasattr(dev, "attach"):
+                dev.attach(self.time)
+            else:
+                dev.clock = self.time
+            if isinstance(dev, PCA9548):
+                for port in dev.ports:
+                    self.attach(port)
+            if isinstance(dev, SFF8472):
+                dev.diag.clock = self.time
+
+    def visible(self, scope=None):
+        if scope is None:
+            scope = self.root
+        for addr, dev in scope.items():
+            if isinstance(dev, SFF8472):
+                yield addr + 1, dev.diag
+            yield addr, dev
+            if isinstance(dev, PCA9548):
+                for port in range(8):
+                    if dev.enabled & (1 << port):
+                        yield from self.visible(dev.ports[port])
+
+    def _account(self, written, read):
+        round_trips, t = self.latency.cost(written, read)
+        self.usb["transactions"] += 1
+        self.usb["bytes"] += written + read
+        self.usb["issued"] += round_trips
+        self.delay(t)
+
+    def delay(self, t):
+        """Let `t` pass on the bus clock"""
+        if self.sleep:
+            time.sleep(t)
+        else:
+            self._skew += t
+
+    def _xfer(self, addr, write=b"", read=None, nack=()):
+        """Write `write` (then restart and read `read` bytes if not None)
+
+        `nack` holds the exceptions for an address/each written byte not
+        acknowledged, `None` entries accept a NACK.
+        """
+        devs = [dev for a, dev in self.visible() if a == addr]
+        written = 1 + len(write)
+        ack = [True]
+        try:
+            if write or read is None:
+                ack = [any([dev.start(False) for dev in devs])]
+                for i, byte in enumerate(write):
+                    ack.append(ack[0] and
+                               any([dev.write(byte) for dev in devs]))
+                for a, exc in zip(ack, nack):
+                    if not a and exc is not None:
+                        raise exc
+            if read is not None:
+                written += bool(write)
+                if not any([dev.start(True) for dev in devs]):
+                    raise I2CNACK("Address Read NACK", addr)
+                data = bytearray(b"\xff"*read)
+                for i in range(read):
+                    for dev in devs:
+                        data[i] &= dev.read()
+                return ack, bytes(data)
+            return ack, None
+        finally:
+            for dev in devs:
+                dev.stop()
+            self._account(written, read or 0)
+
+    def reset(self):
+        # the RESET line only reaches the root switches
+        for dev in self.root.values():
+            if isinstance(dev, PCA9548):
+                dev.enabled = 0
+        self.usb["issued"] += 2
+        self.delay(.01)
+
+    reset_switch = reset
+
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def write_single(self, addr, data, ack=True):
+        self._xfer(addr, bytes([data & 0xff]), nack=(
+            I2CNACK("Address Write NACK", addr),
+            I2CNACK("Data NACK", addr, data) if ack else None))
+
+    def read_single(self, addr):
+        return self._xfer(addr, read=1)[1][0]
+
+    def write_many(self, addr, reg, data, ack=True):
+        data = bytes(byte & 0xff for byte in data)  # like the wire
+        self._xfer(addr, bytes([reg]) + data, nack=(
+            I2CNACK("Address Write NACK", addr), I2CNACK("Reg NACK", reg),
+            *(I2CNACK("Data NACK", data) if ack or i < len(data) - 1
+              else None for i in range(len(data)))))
+
+    def read_many(self, addr, reg, length=1):
+        return self._xfer(addr, bytes([reg]), read=length, nack=(
+            I2CNACK("Address Write NACK", addr),
+            I2CNACK("Reg NACK", reg)))[1]
+
+    def read_stream(self, addr, length=1):
+        return self._xfer(addr, read=length)[1]
+
+    def poll(self, addr, write=False):
+        if write:
+            return self._xfer(addr)[0][0]
+        try:
+            self._xfer(addr, read=0)
+            return True
+        except I2CNACK:
+            return False
+
+
+class FTDI:
+    """Pin level model of the FT4232H interface driving the Kasli bus
+
+    Stands in for `pyftdi.ftdi.Ftdi` below the hardware bus drivers:
+    bitbang pin writes and reads, and the MPSSE SET/GET_BITS_LOW and
+    clocked bit/byte commands of `I2CSync` and `pyftdi.i2c.I2cController`.
+    SCL (pin 0) and SDA (pins 1 and 2) are lines shared with the devices of
+    the simulated `bus`, which are driven bit by bit. SDA driven high by the
+    interface while a device pulls it low raises when sampled on SCL rise.
+    `wiring` is the (EN, RESET, reset_active_high) pin map, the RESET line
+    clears the root switches.
+    """
+    SCL = 1 << 0
+    SDAO = 1 << 1
+    SDAI = 1 << 2
+    SDA = SDAO | SDAI
+
+    def __init__(self, bus=None, wiring=None):
+        self.bus = bus or I2C()
+        self.wiring = wiring
+        self.mpsse = False
+        self.is_connected = False
+        self.out = 0
+        self.dir = 0
+        self.reply = bytearray()
+        self.lines = self.SCL | self.SDA
+        # device side
+        self.state = None
+        self.devs = []
+        self.byte = 0
+        self.bits = 0
+        self.reading = False
+        self.ack = False
+        self.sda_low = False
+
+    # pyftdi.ftdi.Ftdi
+
+    fifo_sizes = 2048, 2048
+    has_wide_port = False
+    mpsse_bit_delay = 1/6e6
+
+    def open_bitbang_from_url(self, url, direction=0, **kwargs):
+        self.mpsse = False
+        self.is_connected = True
+        self.dir = direction
+        return 1e6
+
+    def open_mpsse_from_url(self, url, direction=0, initial=0, **kwargs):
+        self.mpsse = True
+        self.is_connected = True
+        self._set(initial, direction)
+        return kwargs.get("frequency", 6e6)
+
+    def enable_3phase_clock(self, enable=True):
+        pass
+
+    def enable_drivezero_mode(self, lines):
+        from pyftdi.ftdi import FtdiFeatureError
+        raise FtdiFeatureError("no open-drain outputs on FT4232H")
+
+    def set_bitmode(self, direction, mode):
+        self._set(self.out, direction)
+
+    def read_pins(self):
+        return self.pins()
+
+    def close(self, freeze=False):
+        self.is_connected = False
+
+    def purge_rx_buffer(self):
+        self.reply.clear()
+
+    def write_data(self, data):
+        data = bytes(data)
+        if not self.mpsse:
+            for byte in data:
+                self._set(byte, self.dir)
+            return len(data)
+        i = 0
+        while i < len(data):
+            cmd = data[i]
+            if cmd == 0x80:  # SET_BITS_LOW
+                self._set(data[i + 1], data[i + 2])
+                i += 3
+            elif cmd == 0x81:  # GET_BITS_LOW
+                self.reply.append(self.pins())
+                i += 1
+            elif cmd == 0x82:  # SET_BITS_HIGH
+                i += 3
+            elif cmd == 0x83:  # GET_BITS_HIGH
+                self.reply.append(0xff)
+                i += 1
+            elif cmd == 0x87:  # SEND_IMMEDIATE
+                i += 1
+            elif cmd == 0x11:  # WRITE_BYTES_NVE_MSB
+                n = data[i + 1] + (data[i + 2] << 8) + 1
+                for byte in data[i + 3:i + 3 + n]:
+                    for k in range(8):
+                        self._clock(byte << k & 0x80)
+                i += 3 + n
+            elif cmd == 0x13:  # WRITE_BITS_NVE_MSB
+                for k in range(data[i + 1] + 1):
+                    self._clock(data[i + 2] << k & 0x80)
+                i += 3
+            elif cmd == 0x20:  # READ_BYTES_PVE_MSB
+                for j in range(data[i + 1] + (data[i + 2] << 8) + 1):
+                    byte = 0
+                    for k in range(8):
+                        byte = byte << 1 | self._clock()
+                    self.reply.append(byte)
+                i += 3
+            elif cmd == 0x22:  # READ_BITS_PVE_MSB
+                byte = 0
+                for k in range(data[i + 1] + 1):
+                    byte = byte << 1 | self._clock()
+                self.reply.append(byte)
+                i += 2
+            else:
+                raise ValueError("unsupported MPSSE command", hex(cmd))
+        return len(data)
+
+    def read_data_bytes(self, size, attempt=1, request_gen=None):
+        if request_gen is not None and len(self.reply) < size:
+            self.write_data(request_gen(size - len(self.reply)))
+        data = bytes(self.reply[:size])
+        del self.reply[:size]
+        return data
+
+    # pins and lines
+
+    def pins(self):
+        p = (self.out & self.dir | ~self.dir) & 0xff & ~(self.SCL | self.SDA)
+        return p | self.lines
+
+    def enabled(self):
+        return self.wiring is None or self.out & self.dir & self.wiring.en
+
+    def _set(self, out, direction):
+        self.out, self.dir = out, direction
+        if self.wiring is not None:
+            reset = bool(self.out & self.dir & self.wiring.reset)
+            if reset == self.wiring.reset_active_high:
+                for dev in self.bus.root.values():
+                    if isinstance(dev, PCA9548):
+                        dev.enabled = 0
+        self._update()
+
+    def _clock(self, bit=None):
+        """One SCL pulse, driving SDA with `bit`, return SDA while high"""
+        if bit is not None:
+            self.out = self.out & ~self.SDAO | (self.SDAO if bit else 0)
+        self.out |= self.SCL
+        self._update()
+        sda = int(bool(self.lines & self.SDAI))
+        self.out &= ~self.SCL
+        self._update()
+        return sda
+
+    def _update(self):
+        driven = self.dir & ~self.out
+        scl = 0 if driven & self.SCL else self.SCL
+        sda = self._sda()
+        old, self.lines = self.lines, scl | sda
+        if not self.enabled():
+            return
+        # SDA changes count as made while SCL is low, where possible
+        if not scl and old & self.SCL:
+            self._fall()
+        if (sda ^ old) & self.SDA and scl and old & self.SCL:
+            if sda:
+                self._stop()
+            else:
+                self._start()
+        if scl and not old & self.SCL:
+            if self.sda_low and self.dir & self.out & self.SDAO:
+                raise ValueError("SDA driven high against a device")
+            self._rise()
+        # devices change SDA after SCL edges
+        self.lines = scl | self._sda()
+
+    def _sda(self):
+        # the interface driving SDA wins over a device
+        if self.dir & ~self.out & self.SDA:
+            return 0
+        if self.dir & self.out & self.SDAO or not self.sda_low:
+            return self.SDA
+        return 0
+
+    # device side of the bus
+
+    def _start(self):
+        self.state = "addr"
+        self.byte = self.bits = 0
+        self.sda_low = False
+
+    def _stop(self):
+        for dev in self.devs:
+            dev.stop()
+        self.devs = []
+        self.state = None
+        self.sda_low = False
+
+    def _rise(self):
+        sda = bool(self.lines & self.SDAI)
+        if self.state in ("addr", "write"):
+            self.byte = self.byte << 1 | sda
+            self.bits += 1
+        elif self.state == "mack":
+            self.ack = not sda
+
+    def _fall(self):
+        if self.state in ("addr", "write") and self.bits == 8:
+            if self.state == "addr":
+                self.reading = bool(self.byte & 1)
+                self.devs = [dev for a, dev in self.bus.visible()
+                             if a == self.byte >> 1]
+                self.ack = any([dev.start(self.reading)
+                                for dev in self.devs])
+            else:
+                self.ack = any([dev.write(self.byte) for dev in self.devs])
+            self.state = "ack"
+            self.sda_low = self.ack
+        elif self.state == "ack":
+            self.sda_low = False
+            self.byte = self.bits = 0
+            if not self.ack:
+                self.state = "ignore"
+            elif self.reading:
+                self._load()
+            else:
+                self.state = "write"
+        elif self.state == "read":
+            self.bits += 1
+            if self.bits == 8:
+                self.state = "mack"
+                self.sda_low = False
+            else:
+                self.sda_low = not self.byte << self.bits & 0x80
+        elif self.state == "mack":
+            if self.ack:
+                self._load()
+            else:
+                self.state = "ignore"
+
+    def _load(self):
+        self.state = "read"
+        self.byte = 0xff
+        for dev in self.devs:
+            self.byte &= dev.read()
+        self.bits = 0
+        self.sda_low = not self.byte & 0x80
+
+
+def kasli_tree(ports=None, eems=range(12), sfps=(0,), loc_eeprom=0x57,
+               fpga_eems={}):
+    """Kasli crate: switches at 0x70/0x71 wired as in `Kasli.ports`
+
+    Every EEM in `eems` carries an EEPROM, an LM75 and a PCF8574 at 0x3e,
+    `fpga_eems` maps EEM numbers to "banker" (behind a 0x72 switch),
+    "fastino" or "phaser" boards with an SC18IS602B at 0x2a and a SPI flash
+    on SS0. LOC0 has the Si5324
+    and the Kasli EEPROM at `loc_eeprom`.
+    """
+    if ports is None:
+        from kasli import Kasli
+        ports = Kasli.ports
+    root = {0x70: PCA9548(), 0x71: PCA9548()}
+
+    def eui48(i):
+        return bytes([0x80, 0x1f, 0x12, 0x00, 0x01, i])
+
+    def scope(port):
+        (addr, p), = ports[port]
+        return root[addr].ports[p]
+
+    loc = scope("LOC0")
+    loc[0x68] = Si5324()
+    loc[loc_eeprom] = EEPROM(eui48(0xff))
+    for i in eems:
+        s = scope("EEM{}".format(i))
+        kind = fpga_eems.get(i)
+        if kind == "banker":
+            sw = PCA9548()
+            s[0x72] = sw
+            s = sw.ports[0]
+            sw.ports[2][0x2a] = SC18IS602B({0b0001: SPIFlash()})
+        elif kind is not None:
+            s[0x2a] = SC18IS602B({0b0001: SPIFlash()},
+                                 creset_active_high=kind == "phaser")
+        s[0x50] = EEPROM(eui48(i))
+        s[0x48] = LM75(25. + i)
+        s[0x3e] = PCF8574()
+        if kind in ("banker", "phaser"):
+            s[0x49] = LM75(30. + i)
+    for i in sfps:
+        scope("SFP{}".format(i))[0x50] = SFF8472(serial=b"%04d" % i)
+    return root
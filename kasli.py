@@ -1,14 +1,54 @@
 from contextlib import contextmanager
 import logging
+import time
+import json
+import os
+import re
 
 from sinara import Sinara
-from i2c_bitbang import I2C, I2CNACK
+from i2c_bitbang import I2CNACK, WIRINGS
+import i2c_bitbang
+import i2c_mpsse
+import i2c_sim
 import chips
 
 logger = logging.getLogger(__name__)
 
 
-class Kasli(I2C, chips.ScanI2C):
+def graph_to_json(graph):
+    return {"{:#04x}".format(addr): None if ports is None else
+            [graph_to_json(sub) for sub in ports]
+            for addr, ports in graph.items()}
+
+
+def graph_from_json(graph):
+    return {int(addr, 16): None if ports is None else
+            [graph_from_json(sub) for sub in ports]
+            for addr, ports in graph.items()}
+
+
+class Kasli(chips.ScanI2C):
+    """Kasli I2C tree on a selectable bus backend
+
+    The backend is chosen at `configure()` time. With "auto" (the
+    default) every backend in `auto` usable on the port is tried and the
+    one with the highest measured throughput is used. The "sync" and
+    "mpsse" backends need an MPSSE interface (FT4232H ports 1 and 2), on
+    ports 3 and 4 (Kasli v1.0) this is bitbang. The EN/RESET `wiring` is
+    taken from the hardware revision in the FTDI serial number (e.g.
+    Kasli-v1.0-2) if not given, with "probe" it is found on the bus. Bus
+    methods (`write_single()`, `read_many()`, `poll()`, ...) are those of
+    the backend.
+    """
+    backends = {
+        "bitbang": i2c_bitbang.I2C,
+        "sync": i2c_bitbang.I2CSync,
+        "mpsse": i2c_mpsse.I2C,
+        "sim": i2c_sim.I2C,
+    }
+    auto = ["mpsse", "sync", "bitbang"]
+    mpsse = {"mpsse", "sync"}  # backends needing an MPSSE interface
+    mpsse_interfaces = (1, 2)
     ports = {
         "ROOT": [],
         "EEM0": [(0x70, 7)],
@@ -29,23 +69,229 @@ class Kasli(I2C, chips.ScanI2C):
         "LOC0": [(0x71, 3)],
     }
     skip = []
+    # chips read by `snapshot()`
+    health = {
+        "lm75": chips.LM75,
+        "si5324": chips.Si5324,
+        "sff8472": chips.SFF8472,
+    }
+
+    def __init__(self, backend="auto", wiring=None, **kwargs):
+        self.backend = backend
+        self.wiring = wiring
+        self.kwargs = kwargs  # backend constructor arguments
+        self.throughput = {}
+        self.i2c = None
+        self.last_inventory = None  # of the previous `snapshot()`
+        self.mux = chips.MuxTree(self, sorted(
+            {addr for path in self.ports.values() for addr, port in path}))
+
+    def __getattr__(self, name):
+        if name == "i2c":
+            raise AttributeError(name)
+        return getattr(self.i2c, name)
+
+    def _open(self, backend, url, **kwargs):
+        kw = dict(self.kwargs)
+        if backend != "sim":
+            kw["wiring"] = self.wiring
+        return self.backends[backend](**kw).configure(url, **kwargs)
+
+    def configure(self, url, backend=None, **kwargs):
+        backend = backend or self.backend
+        if url.startswith("sim"):
+            backend = "sim"
+        if backend != "sim":
+            if self.wiring is None:
+                self.wiring = self.revision_wiring(url)
+            elif self.wiring == "probe":
+                self.wiring = self.probe_wiring(url)
+        if backend == "auto":
+            interface = url.rsplit("/", 1)[-1]
+            for name in self.auto:
+                if name in self.mpsse and not (interface.isdigit() and int(
+                        interface) in self.mpsse_interfaces):
+                    logger.info("backend %s needs an MPSSE port", name)
+                    continue
+                try:
+                    i2c = self._open(name, url, **kwargs)
+                except Exception as e:
+                    logger.info("backend %s unavailable: %s", name, e)
+                    continue
+                try:
+                    with i2c:
+                        i2c.reset()
+                        self.throughput[name] = self.measure(i2c)
+                    logger.info("backend %s: %.1f transactions/s", name,
+                                self.throughput[name])
+                except Exception as e:
+                    logger.info("backend %s failed: %s", name, e)
+                finally:
+                    i2c.close()
+            if not self.throughput:
+                raise ValueError("no working bus backend", url)
+            backend = max(self.throughput, key=self.throughput.get)
+        self.backend = backend
+        self.url = url
+        self.i2c = self._open(backend, url, **kwargs)
+        logger.info("backend %s, wiring %s", backend, self.wiring)
+        return self
+
+    @staticmethod
+    def revision_wiring(url):
+        """Wiring of the hardware revision in the FTDI serial number,
+        None (the backend defaults) if there is none"""
+        m = re.search(r"v(\d+)\.(\d+)", url)
+        if m is None:
+            return None
+        rev = int(m.group(1)), int(m.group(2))
+        if rev < (2, 0):
+            return WIRINGS["v1"]
+        elif rev == (2, 0):
+            return WIRINGS["v2.0"]
+        return WIRINGS["v2"]
+
+    @classmethod
+    def probe_wiring(cls, url):
+        """Find EN pin and RESET polarity where both switches respond
+
+        This drives EN and RESET of every candidate wiring in turn, only
+        use it on boards of unknown revision.
+        """
+        for rev, wiring in WIRINGS.items():
+            i2c = i2c_bitbang.I2C(wiring).configure(url)
+            try:
+                with i2c:
+                    i2c.reset()
+                    if i2c.poll(0x70, write=True) and i2c.poll(
+                            0x71, write=True):
+                        logger.info("wiring %s", rev)
+                        return wiring
+            except ValueError as e:
+                logger.debug("wiring %s: %s", rev, e)
+            finally:
+                i2c.close()
+        raise ValueError("switches not found with any wiring", url)
+
+    def measure(self, i2c=None, n=8):
+        """Measure and return transactions per second"""
+        if i2c is None:
+            i2c = self.i2c
+        t = time.monotonic()
+        for i in range(n):
+            if not i2c.poll(0x70, write=True):
+                raise ValueError("switch not responding")
+        return n/(time.monotonic() - t)
+
+    def acquire(self):
+        self.i2c.acquire()
+
+    def release(self):
+        self.i2c.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def reset(self):
+        self.i2c.reset()
+        self.mux.reset()
+
+    def path(self, port):
+        """Switch path of a port
 
-    def enable(self, *ports):
-        bits = {0x70: 0, 0x71: 0}
+        Ports behind on-board switches are named by their hops below the
+        Kasli port, e.g. "EEM4/0x72:0" for port 0 of the switch at 0x72 on
+        EEM4.
+        """
+        port, *hops = port.split("/")
+        path = list(self.ports[port])
+        for hop in hops:
+            addr, p = hop.split(":")
+            path.append((int(addr, 16), int(p)))
+        return path
+
+    def port_name(self, path):
+        """Port of a switch path, the inverse of `path()`"""
+        for port, base in self.ports.items():
+            if base and list(path[:len(base)]) == base:
+                return port + "".join("/{:#04x}:{}".format(addr, p)
+                                      for addr, p in path[len(base):])
+        return None
+
+    def enable(self, *ports, verify=False):
         for port in ports:
-            assert port not in self.skip
-            for addr, p in self.ports[port]:
-                bits[addr] |= (1 << p)
-        for addr in sorted(bits):
-            self.write_single(addr, bits[addr])
+            assert port.split("/")[0] not in self.skip
+        self.mux.enable(*(self.path(port) for port in ports), verify=verify)
 
     @contextmanager
     def enabled(self, *ports):
+        paths = self.mux.paths
         self.enable(*ports)
         try:
             yield self
         finally:
-            self.enable()
+            self.mux.enable(*paths)
+
+    def scan_tree(self, *args, **kwargs):
+        # writes switches behind the back of the shadow
+        try:
+            yield from super().scan_tree(*args, **kwargs)
+        finally:
+            self.mux.invalidate()
+
+    def topology_key(self):
+        """Kasli EUI-48, the FTDI URL if the EEPROM does not respond"""
+        with self.enabled("LOC0"):
+            for addr in 0x57, 0x50:  # v2, v1
+                if self.poll(addr, write=True):
+                    return chips.EEPROM(self, addr).fmt_eui48()
+        return re.sub(r"\W+", "_", self.url)
+
+    def scan_topology(self, cache="topology", full=False):
+        """Scan the I2C tree, incrementally against the cached topology"""
+        fil = os.path.join(cache, "{}.json".format(self.topology_key()))
+        cached = None
+        if not full and os.path.exists(fil):
+            with open(fil) as f:
+                cached = graph_from_json(json.load(f))
+        self.enable()
+        try:
+            graph = self.scan_graph(cached=cached)
+        finally:
+            self.mux.invalidate()
+        with open(fil, "w") as f:
+            json.dump(graph_to_json(graph), f, indent=1)
+        return graph
+
+    def topology_expect(self, cache="topology"):
+        """Addresses per port like `Inventory.expect()` from the cached
+        topology, scanned if there is none"""
+        fil = os.path.join(cache, "{}.json".format(self.topology_key()))
+        if os.path.exists(fil):
+            with open(fil) as f:
+                graph = graph_from_json(json.load(f))
+        else:
+            graph = self.scan_topology(cache)
+        expect = {}
+
+        def walk(scope, path):
+            port = self.port_name(path)
+            for addr, ports in scope.items():
+                if port is not None:
+                    expect.setdefault(port, []).append(addr)
+                for p, sub in enumerate(ports or ()):
+                    walk(sub, path + [(addr, p)])
+        walk(graph, [])
+        return {port: sorted(addrs) for port, addrs in expect.items()}
+
+    def port_order(self):
+        """Ports sorted by switch path, minimizes switch writes"""
+        return sorted((port for port in self.ports if port not in self.skip),
+                      key=self.ports.get)
 
     def names(self, paths):
         rev = dict((v, k) for k, v in self.ports)
@@ -57,9 +303,7 @@ class Kasli(I2C, chips.ScanI2C):
                 chips.Si5324(self), chips.SFF8472(self)]
         devs = {dev.addr: dev for dev in devs}
 
-        for port in sorted(self.ports):
-            if port in self.skip:
-                continue
+        for port in self.port_order():
             self.enable(port)
             logger.info("%s: ...", port)
             for addr in self.scan():
@@ -68,16 +312,80 @@ class Kasli(I2C, chips.ScanI2C):
                 else:
                     logger.debug("ignoring addr %#02x", addr)
 
+    def inventory(self, expect=None, full=False):
+        """Identify the chips on all ports into a `chips.Inventory`
+
+        Switches found on a port are followed, the chips behind them are
+        listed under nested ports (see `path()`). `expect` maps ports to
+        addresses (e.g. from an earlier `Inventory.expect()`), ports not
+        listed are skipped.
+        """
+        inv = chips.Inventory()
+        for port in self.port_order():
+            if expect is None or port in expect:
+                self._inventory(inv, port, expect, full)
+        return inv
+
+    def _inventory(self, inv, port, expect, full):
+        self.enable(port)
+        # the root switches respond everywhere
+        skip = {addr for path in self.ports.values() for addr, p in path}
+        skip.update(addr for addr, p in self.path(port))
+        want = None if expect is None else expect[port]
+        found = self.scan_chips(want, full, skip)
+        switches = [addr for addr, chip in found.items()
+                    if chip.kind == "pca9548"]
+        if any(found[addr].info["ports"] for addr in switches):
+            # chips behind a switch left on showed up in this scope
+            for addr in switches:
+                self.mux.set_switch(addr, 0)
+            found = self.scan_chips(want, full, skip)
+        if found:
+            inv[port] = found
+        for addr in switches:
+            for p in range(8):
+                sub = self.port_name(self.path(port) + [(addr, p)])
+                if expect is None or sub in expect:
+                    self._inventory(inv, sub, expect, full)
+
+    def snapshot(self, inventory=None):
+        """Read all temperature, clock and SFP sensors in one sweep
+
+        `inventory` is an earlier `inventory()`. By default that of the
+        previous snapshot is reused, the first one is taken against the
+        cached topology (`topology_expect()`). Limits and static data are
+        cached by the chip classes, so repeated snapshots only read the
+        live registers.
+        """
+        if inventory is None:
+            if self.last_inventory is None:
+                self.last_inventory = self.inventory(self.topology_expect())
+            inventory = self.last_inventory
+        snap = chips.Snapshot()
+        for port in sorted(inventory, key=self.path):
+            found = [chip for chip in inventory[port].values()
+                     if chip.kind in self.health]
+            if not found:
+                continue
+            self.enable(port)
+            for chip in found:
+                try:
+                    v = self.health[chip.kind](self, chip.addr).sample()
+                except Exception as e:
+                    v = dict(error=repr(e))
+                snap.setdefault(port, {})[chip.addr] = dict(
+                    v, kind=chip.kind)
+        return snap
+
     def dump_eeproms(self, **kwargs):
         ee = chips.EEPROM(self, **kwargs)
-        for port in sorted(self.ports):
-            if port in self.skip:
-                continue
+        for port in self.port_order():
             self.enable(port)
             if self.poll(ee.addr):
-                eui48 = ee.fmt_eui48()
+                image = ee.dump()
+                eui48 = ee.fmt_eui48(image[0xfa:])
                 logger.info("Port %s: found %s", port, eui48)
-                open("data/{}.bin".format(eui48), "wb").write(ee.dump())
+                open("data/{}.bin".format(eui48), "wb").write(image)
 
 
 if __name__ == "__main__":
@@ -91,6 +399,24 @@ if __name__ == "__main__":
     # EEM1 (port 5) SDA shorted on Kasli-v1.0-2
     p.add_argument("-k", "--skip", action="append", default=[])
     p.add_argument("-e", "--eem", default=None)
+    p.add_argument("-b", "--backend", default="auto",
+                   choices=["auto"] + sorted(Kasli.backends))
+    p.add_argument("-w", "--wiring", default=None,
+                   choices=sorted(WIRINGS) + ["probe"],
+                   help="hardware revision wiring, \"probe\" to find it "
+                   "on the bus (default: from the serial number)")
+    p.add_argument("-f", "--full", action="store_true",
+                   help="ignore the cached topology")
+    p.add_argument("--solve", action="store_true",
+                   help="solve the Si5324 plan for the frequencies below "
+                   "(default: the fixed 125 MHz free run plan)")
+    p.add_argument("--ckin1", default=None, type=float,
+                   help="Si5324 CKIN1 frequency")
+    p.add_argument("--ckin2", default=114.285e6, type=float,
+                   help="Si5324 CKIN2 frequency")
+    p.add_argument("--ckout", default=125e6, type=float,
+                   help="Si5324 CKOUT frequency")
+    p.add_argument("--bwsel", default=4, type=int)
     p.add_argument("-v", "--verbose", default=0, action="count")
 
     p.add_argument("action", nargs="*")
@@ -102,7 +428,10 @@ if __name__ == "__main__":
         level=[logging.WARNING, logging.INFO, logging.DEBUG][args.verbose])
 
     url = "ftdi://ftdi:4232h:{}/{}".format(args.serial, args.port)
-    with Kasli().configure(url) as bus:
+    if args.backend == "sim":
+        url = "sim"
+    wiring = WIRINGS.get(args.wiring, args.wiring)
+    with Kasli(args.backend, wiring).configure(url) as bus:
         bus.skip = args.skip
         bus.reset()
         # bus.clear()
@@ -113,6 +442,18 @@ if __name__ == "__main__":
                     logger.warning("%s", t)
                     logger.warning("%s", bus.make_graph(t))
                     logger.warning("\n" + "\n".join(bus.format_graph(bus.make_graph(t))))
+                elif action == "topology":
+                    g = bus.scan_topology(full=args.full)
+                    logger.warning("\n" + "\n".join(bus.format_graph(g)))
+                elif action == "inventory":
+                    bus.inventory(full=args.full).report()
+                elif action == "health":
+                    t = time.monotonic()
+                    snap = bus.snapshot()
+                    snap.report()
+                    logger.warning("health snapshot: %d alarms, %.3f s",
+                                   len(list(snap.alarms())),
+                                   time.monotonic() - t)
                 elif action == "scan":
                     bus.scan_devices()
                 elif action == "dump_eeproms":
@@ -124,25 +465,13 @@ if __name__ == "__main__":
                 elif action == "si5324":
                     bus.enable("LOC0")
                     si = chips.Si5324(bus)
-                    s = chips.Si5324.FrequencySettings()
-                    if True:
-                        s.n31 = 4993  # 100 MHz CKIN1
-                        s.n32 = 4565  # 114.285 MHz CKIN2 XTAL
-                        s.n1_hs = 10
-                        s.nc1_ls = 4
-                        s.nc2_ls = 4
-                        s.n2_hs = 10
-                        s.n2_ls = 19972  # 125MHz CKOUT
-                        s.bwsel = 4
+                    if args.solve:
+                        s, *_ = chips.Si5324.FrequencySettings.solve(
+                            args.ckout, args.ckin1, args.ckin2, args.bwsel)
                     else:
-                        s.n31 = 65  # 125 MHz CKIN1
-                        s.n32 = 52  # 100 MHz CKIN2 (not free run)
-                        s.n1_hs = 10
-                        s.nc1_ls = 4
-                        s.nc2_ls = 4
-                        s.n2_hs = 10
-                        s.n2_ls = 260  # 125MHz CKOUT
-                        s.bwsel = 10
+                        # free run from the 114.285 MHz XTAL
+                        s = chips.Si5324.FrequencySettings.default()
+                    logger.info("%s", s)
                     si.setup(s)
                     logger.warning("flags %s %s %s", si.has_xtal(),
                                    si.has_clkin2(), si.locked())
@@ -0,0 +1,320 @@
+import logging
+import time
+import json
+import os
+import re
+import threading
+import socketserver
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import chips
+
+logger = logging.getLogger(__name__)
+
+
+# samplers return a function reading the chip into a dict of values
+
+
+def read_lm75(bus, addr):
+    # thresholds and config are cached, one temperature read per sample
+    return chips.LM75(bus, addr).sample
+
+
+def read_si5324(bus, addr):
+    return chips.Si5324(bus, addr).sample
+
+
+def read_sff8472(bus, addr):
+    # static pages once, then the 10 live DDM bytes per sample
+    sfp = chips.SFF8472(bus, addr)
+    return lambda: sfp.sample(flags=False)
+
+
+# chip kind: (sampler, default period)
+readers = {
+    "lm75": (read_lm75, 10.),
+    "si5324": (read_si5324, 1.),
+    "sff8472": (read_sff8472, 10.),
+}
+
+
+class Sensor:
+    """One scheduled chip reading and its recent history
+
+    With a `store` directory the history is kept in a `RingStore` file
+    per sensor instead of in memory.
+    """
+    def __init__(self, port, kind, addr, period=None, history=1000,
+                 store=None):
+        self.port = port
+        self.kind = kind
+        self.addr = addr
+        self.sampler, default = readers[kind]
+        self.sample = None
+        self.period = period or default
+        self.name = "{}/{}@{:#04x}".format(port, kind, addr)
+        self.due = 0.
+        self.t = None  # time of the latest value
+        self.value = None
+        self.errors = 0
+        self.history = deque(maxlen=history)
+        self.store = store
+        self.ring = None  # RingStore, opened with the first value
+
+    def read(self, bus):
+        if self.sample is None:
+            self.sample = self.sampler(bus, self.addr)
+        return self.sample()
+
+    def record(self, t, value):
+        self.t, self.value = t, value
+        if self.store is None:
+            self.history.append((t, value))
+            return
+        if self.ring is None:
+            from timeseries import RingStore
+            fil = os.path.join(self.store, re.sub(r"\W+", "_", self.name))
+            self.ring = RingStore(fil + ".ts", [
+                (k, "<f4") for k in sorted(value)], self.history.maxlen)
+        self.ring.append(t, **value)
+
+    def last(self, n=None):
+        """The latest `n` (default: all) history entries (t, value)"""
+        if self.ring is None:
+            h = list(self.history)
+            return h if n is None else h[-n:]
+        rows = self.ring.last(len(self.ring) if n is None else n)
+        names = rows.dtype.names[1:]
+        return [(float(r["t"]), {k: float(r[k]) for k in names})
+                for r in rows]
+
+
+class Telemetry:
+    """Periodic sensor readout keeping the bus open
+
+    Due sensors are read in mux path order so that consecutive reads on
+    the same port share the switch setting. Values, history, staleness and
+    bus utilisation are available from `latest()`, `metrics()` and the
+    socket servers of `serve()`.
+    """
+    def __init__(self, bus, sensors=()):
+        self.bus = bus
+        self.sensors = {s.name: s for s in sensors}
+        self.clock = getattr(bus, "time", time.monotonic)
+        self.sleep = getattr(bus, "delay", time.sleep)
+        self.lock = threading.Lock()
+        self.start = self.clock()
+        # value time stamps are wall time, also with the simulated clock
+        self.epoch = time.time() - self.start
+        self.busy = 0.
+        self.sweeps = 0
+        self.servers = []
+
+    @classmethod
+    def from_inventory(cls, bus, inventory, periods={}, history=1000,
+                       store=None):
+        """Sensors for all readable chips in a `chips.Inventory`"""
+        sensors = []
+        for port, found in inventory.items():
+            for chip in found.values():
+                if chip.kind in readers:
+                    sensors.append(Sensor(port, chip.kind, chip.addr,
+                                          periods.get(chip.kind), history,
+                                          store))
+        return cls(bus, sensors)
+
+    def sweep(self):
+        """Read all due sensors, return the time until the next one is due"""
+        now = self.clock()
+        due = sorted((s for s in self.sensors.values() if s.due <= now),
+                     key=lambda s: (self.bus.path(s.port), s.addr))
+        t0 = now
+        for s in due:
+            try:
+                self.bus.enable(s.port)
+                value = s.read(self.bus)
+            except Exception:
+                logger.warning("%s read failed", s.name, exc_info=True)
+                with self.lock:
+                    s.errors += 1
+                    s.sample = None  # re-identify, the module may be new
+                value = None
+            now = self.clock()
+            # keep the phase, skip missed periods
+            s.due += s.period*max(1, (now - s.due)//s.period + 1)
+            if value is not None:
+                with self.lock:
+                    s.record(now + self.epoch, value)
+        with self.lock:
+            self.busy += now - t0
+            self.sweeps += bool(due)
+        now = self.clock()
+        # without sensors poll idly, once a second
+        return max(0., min((s.due for s in self.sensors.values()),
+                           default=now + 1.) - now)
+
+    def run(self, duration=None):
+        end = None if duration is None else self.clock() + duration
+        while end is None or self.clock() < end:
+            wait = self.sweep()
+            if end is not None:
+                wait = min(wait, end - self.clock())
+            if wait > 0:
+                self.sleep(wait)
+
+    def utilisation(self):
+        """Fraction of the time spent on the bus"""
+        return self.busy/max(self.clock() - self.start, 1e-9)
+
+    def latest(self):
+        now = self.clock() + self.epoch
+        with self.lock:
+            return {name: dict(
+                t=s.t, age=None if s.t is None else now - s.t,
+                period=s.period, errors=s.errors, value=s.value)
+                for name, s in self.sensors.items()}
+
+    def history(self, name, n=None):
+        with self.lock:
+            return self.sensors[name].last(n)
+
+    def metrics(self):
+        """Prometheus text exposition of values, staleness and bus use"""
+        now = self.clock() + self.epoch
+        lines = []
+        with self.lock:
+            for s in self.sensors.values():
+                labels = 'port="{}",addr="{:#04x}"'.format(s.port, s.addr)
+                for k, v in sorted((s.value or {}).items()):
+                    if not isinstance(v, (int, float)):
+                        continue  # e.g. lists of alarm flags
+                    lines.append("kasli_{}_{}{{{}}} {}".format(
+                        s.kind, k, labels, float(v)))
+                if s.t is not None:
+                    lines.append("kasli_sensor_age_seconds{{{},kind=\"{}\"}} "
+                                 "{}".format(labels, s.kind, now - s.t))
+                lines.append("kasli_sensor_errors_total{{{},kind=\"{}\"}} "
+                             "{}".format(labels, s.kind, s.errors))
+            lines.append("kasli_bus_utilisation {}".format(
+                self.utilisation()))
+            lines.append("kasli_sweeps_total {}".format(self.sweeps))
+        usb = getattr(self.bus, "usb", {})
+        for k in "transactions", "bytes", "issued":
+            lines.append("kasli_bus_{}_total {}".format(k, usb.get(k, 0)))
+        return "\n".join(lines) + "\n"
+
+    def handle(self, line):
+        """Unix socket request: `latest`, `history NAME [N]`, `metrics`"""
+        cmd, *args = line.split()
+        if cmd == "latest":
+            return json.dumps(self.latest())
+        elif cmd == "history":
+            n = int(args[1]) if len(args) > 1 else None
+            return json.dumps(self.history(args[0], n))
+        elif cmd == "metrics":
+            return self.metrics()
+        raise ValueError("unknown request", cmd)
+
+    def serve(self, path=None, http=None):
+        """Serve on a Unix socket `path` and a (host, port) HTTP address"""
+        telemetry = self
+
+        class UnixHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        reply = telemetry.handle(line.decode())
+                    except Exception as e:
+                        reply = json.dumps(dict(error=repr(e)))
+                    self.wfile.write(reply.rstrip("\n").encode() + b"\n")
+
+        class HTTPHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = telemetry.metrics().encode()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                logger.debug(fmt, *args)
+
+        if path is not None:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.servers.append(socketserver.ThreadingUnixStreamServer(
+                path, UnixHandler))
+        if http is not None:
+            self.servers.append(ThreadingHTTPServer(http, HTTPHandler))
+        for server in self.servers:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever,
+                             daemon=True).start()
+
+    def shutdown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers.clear()
+
+
+if __name__ == "__main__":
+    import argparse
+    from kasli import Kasli
+
+    p = argparse.ArgumentParser()
+    p.add_argument("-s", "--serial", default="0")
+    p.add_argument("-p", "--port", default=2, type=int)
+    p.add_argument("-b", "--backend", default="auto",
+                   choices=["auto"] + sorted(Kasli.backends))
+    p.add_argument("--socket", default="kasli-telemetry.sock",
+                   help="Unix socket path")
+    p.add_argument("--http", default="localhost:9110",
+                   help="Prometheus endpoint address, empty to disable")
+    p.add_argument("-r", "--rate", action="append", default=[],
+                   help="read period per chip kind, e.g. lm75=5")
+    p.add_argument("--history", default=1000, type=int,
+                   help="history length per sensor")
+    p.add_argument("--store", default=None,
+                   help="keep the history in ring buffer files here")
+    p.add_argument("-d", "--duration", default=None, type=float)
+    p.add_argument("-v", "--verbose", default=0, action="count")
+    args = p.parse_args()
+
+    logging.basicConfig(
+        level=[logging.WARNING, logging.INFO, logging.DEBUG][args.verbose])
+
+    periods = {}
+    for rate in args.rate:
+        kind, period = rate.split("=")
+        if kind not in readers:
+            raise ValueError("unknown chip kind", kind)
+        periods[kind] = float(period)
+    url = "ftdi://ftdi:4232h:{}/{}".format(args.serial, args.port)
+    if args.backend == "sim":
+        url = "sim"
+    with Kasli(args.backend).configure(url) as bus:
+        bus.reset()
+        try:
+            t = Telemetry.from_inventory(bus, bus.inventory(), periods,
+                                         args.history, args.store)
+            logger.info("sensors: %s", ", ".join(t.sensors))
+            http = None
+            if args.http:
+                host, port = args.http.rsplit(":", 1)
+                http = host, int(port)
+            t.serve(args.socket, http)
+            try:
+                t.run(args.duration)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                t.shutdown()
+        finally:
+            bus.enable()
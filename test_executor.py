@@ -0,0 +1,45 @@
+import os
+import threading
+
+import i2c_sim
+import telemetry
+from executor import BusExecutor, BULK, INTERACTIVE
+from flash_eem import Board, profiles
+from kasli import Kasli
+
+
+def test_read_during_flash_program():
+    bus = Kasli("sim", root=i2c_sim.kasli_tree(
+        fpga_eems={4: "fastino"})).configure("sim")
+    data = os.urandom(2*0x1000 + 100)
+    sensor = telemetry.Sensor("EEM0", "lm75", 0x48)
+    log = []
+    started, queued = threading.Event(), threading.Event()
+
+    def program(bus):
+        b = Board(bus, profiles["fastino"])
+        b.init()
+        with b.flash_upd():
+            for i, _ in enumerate(b.program_steps(data)):
+                log.append("flash")
+                if i == 0:
+                    started.set()
+                    assert queued.wait(1.)
+                yield
+        return b.flash.read(0, len(data))
+
+    def read(bus):
+        log.append("read")
+        return sensor.read(bus)
+
+    with bus, BusExecutor(bus) as ex:
+        bus.reset()
+        flashed = ex.submit(program, "EEM4", priority=BULK)
+        assert started.wait(1.)
+        temperature = ex.submit(read, sensor.port, priority=INTERACTIVE)
+        queued.set()
+        assert temperature.result()["temperature"] == 25.
+        assert flashed.result() == data
+    # the read ran between two flash steps, not after the program
+    assert log.index("read") == 1
+    assert log.count("flash") > 10
@@ -0,0 +1,72 @@
+import pytest
+
+import i2c_bitbang
+import i2c_mpsse
+import i2c_sim
+from i2c_bitbang import WIRINGS
+
+
+def open_sim(cls, wiring=WIRINGS["v2"]):
+    """Hardware bus driver on the pin level FT4232H model"""
+    bus = i2c_sim.I2C(i2c_sim.kasli_tree())
+    i2c = cls(wiring)
+    dev = i2c_sim.FTDI(bus, wiring)
+    if isinstance(i2c, i2c_mpsse.I2C):
+        i2c._ftdi = dev
+    else:
+        i2c.dev = dev
+    return bus, i2c.configure("ftdi://ftdi:4232h:sim/1")
+
+
+@pytest.mark.parametrize("cls", [
+    i2c_bitbang.I2C, i2c_bitbang.I2CSync, i2c_mpsse.I2C])
+def test_driver(cls):
+    bus, i2c = open_sim(cls)
+    with i2c:
+        bus.root[0x70].enabled = 0xff
+        i2c.reset()
+        assert bus.root[0x70].enabled == 0
+        assert i2c.poll(0x70, write=True)
+        assert not i2c.poll(0x33, write=True)
+        i2c.write_single(0x71, 1 << 3)  # LOC0
+        assert bus.root[0x71].enabled == 1 << 3
+        assert i2c.read_single(0x71) == 1 << 3
+        assert i2c.read_many(0x57, 0xfa, 6) == bytes.fromhex("801f120001ff")
+        i2c.write_many(0x57, 0x10, b"\x12\x34")
+        while not i2c.poll(0x57, write=True):
+            pass
+        assert i2c.read_many(0x57, 0x10, 2) == b"\x12\x34"
+
+
+def test_batch():
+    bus, i2c = open_sim(i2c_mpsse.I2C)
+    with i2c:
+        with i2c.batch() as b:
+            b.write_single(0x70, 1 << 7)  # EEM0
+            assert b.read_many(0x50, 0xfa, 6) == 1
+            b.read_many(0x48, 0x00, 2)
+            b.poll(0x33, write=True)
+            b.write_many(0x48, 0x01, [0x02])
+            b.read_stream(0x48, 1)
+        assert i2c.usb["issued"] == 1
+        assert [r.acks for r in b.results] == [
+            [True, True], [True, True, True], [True, True, True],
+            [False], [True, True, True], [True]]
+        assert b.results[1].data == bytes.fromhex("801f12000100")
+        assert b.results[2].data == b"\x19\x00"  # 25 C
+        assert b.results[5].data == b"\x02"
+        assert bus.root[0x70].enabled == 1 << 7
+
+
+def test_batch_chunks():
+    bus, i2c = open_sim(i2c_mpsse.I2C)
+    with i2c:
+        b = i2c.batch()
+        b.write_single(0x71, 1 << 3)  # LOC0
+        for i in range(8):
+            b.read_many(0x57, 0x00, 256)
+        results = b.execute()
+        assert i2c.usb["issued"] > 1
+        assert len(results) == 9
+        assert all(r.data == results[1].data for r in results[1:])
+        assert results[1].data[0xfa:] == bytes.fromhex("801f120001ff")
@@ -0,0 +1,119 @@
+import logging
+import json
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class RingStore:
+    """Fixed-record time series ring buffer in a memory mapped file
+
+    Records are NumPy structured rows with a float64 time column `t`
+    followed by `columns` (name, dtype). The file holds a JSON header page
+    and `capacity` records, the oldest are overwritten once full. Appends
+    touch one record and the header counter, range queries return views
+    into the map.
+    """
+    magic = b"KTS1"
+    header = 4096
+
+    def __init__(self, fil, columns=None, capacity=1 << 16):
+        self.fil = fil
+        if os.path.exists(fil):
+            with open(fil, "rb") as f:
+                head = f.read(self.header)
+            if head[:4] != self.magic:
+                raise ValueError("not a time series store", fil)
+            meta = json.loads(head[4:self.header - 8].rstrip(b"\x00"))
+            columns = meta["columns"]
+            capacity = meta["capacity"]
+        elif columns is None:
+            raise ValueError("new store needs columns", fil)
+        self.columns = [tuple(c) for c in columns]
+        self.capacity = capacity
+        self.dtype = np.dtype([("t", "<f8")] + self.columns)
+        if not os.path.exists(fil):
+            head = self.magic + json.dumps(dict(
+                columns=self.columns, capacity=capacity)).encode()
+            if len(head) > self.header - 8:
+                raise ValueError("too many columns", len(columns))
+            with open(fil, "wb") as f:
+                f.write(head)
+                f.truncate(self.header + capacity*self.dtype.itemsize)
+        # the number of records appended lives in the last header word
+        self._count = np.memmap(fil, "<u8", "r+", self.header - 8, 1)
+        self.data = np.memmap(fil, self.dtype, "r+", self.header, capacity)
+
+    def __len__(self):
+        return int(min(self._count[0], self.capacity))
+
+    @property
+    def count(self):
+        """Records appended over the lifetime of the store"""
+        return int(self._count[0])
+
+    def append(self, t, *values, **kw):
+        """Append one record by position or column name"""
+        i = self.count % self.capacity
+        row = self.data[i:i + 1]
+        row["t"] = t
+        for (name, _), v in zip(self.columns, values):
+            row[name] = v
+        for name, v in kw.items():
+            row[name] = v
+        self._count[0] += 1
+
+    def extend(self, records):
+        """Append a structured array of records"""
+        records = np.asarray(records, self.dtype)
+        skip = max(0, len(records) - self.capacity)
+        self._count[0] += skip
+        records = records[skip:]
+        i = self.count % self.capacity
+        n = min(len(records), self.capacity - i)
+        self.data[i:i + n] = records[:n]
+        self.data[:len(records) - n] = records[n:]
+        self._count[0] += len(records)
+
+    def segments(self):
+        """The stored records as up to two views, oldest first"""
+        i = self.count % self.capacity
+        if self.count <= self.capacity:
+            return [self.data[:self.count]]
+        return [self.data[i:], self.data[:i]]
+
+    def range(self, t0=None, t1=None):
+        """Records with `t0 <= t < t1` (times are expected monotonic)
+
+        A view unless the range wraps around the end of the buffer.
+        """
+        parts = []
+        for seg in self.segments():
+            a = 0 if t0 is None else np.searchsorted(seg["t"], t0, "left")
+            b = len(seg) if t1 is None else np.searchsorted(
+                seg["t"], t1, "left")
+            if b > a:
+                parts.append(seg[a:b])
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return self.data[:0]
+        return np.concatenate(parts)
+
+    def last(self, n=1):
+        """The latest `n` records"""
+        n = min(n, len(self))
+        end = (self.count - 1) % self.capacity + 1 if self.count else 0
+        if n <= end:
+            return self.data[end - n:end]
+        return np.concatenate([self.data[end - n:], self.data[:end]])
+
+    def flush(self):
+        self.data.flush()
+        self._count.flush()
+
+    def close(self):
+        self.flush()
+        del self.data, self._count